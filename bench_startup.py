@@ -0,0 +1,71 @@
+# Startup time benchmark for crism.py.
+#
+# Every render starts a new python3 process, so the time to import crism.py adds to each
+# image, and --help should answer at once. rasterio (GDAL), spectres, fire, zarr,
+# http.server and socketserver are therefore imported by the functions using them, and the matching
+# function tables are loaded on first use. This script checks that importing crism.py
+# doesn't pull in any of them and stays within the time budget, using python -X importtime.
+#
+# Usage:
+# python3 bench_startup.py [--runs=N]
+#
+# Exits with status 1 if a budget is exceeded or a heavy module is imported at startup.
+
+import os
+import re
+import subprocess
+import sys
+import time
+
+#Budgets in milliseconds. Most of the import time is numpy itself.
+IMPORT_BUDGET_MS = 200
+COMMAND_BUDGET_MS = 600
+
+#Modules which must not be imported by "import crism"
+LAZY_MODULES = ["rasterio", "spectres", "fire", "zarr", "http.server", "socketserver"]
+
+SCRIPTDIR = os.path.dirname(os.path.abspath(__file__))
+
+def import_time_ms():
+    """Returns the cumulative import time of crism reported by python -X importtime."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import crism"],
+                            cwd=SCRIPTDIR, capture_output=True, text=True, check=True)
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \| crism$", line)
+        if match:
+            return int(match.group(1)) / 1000
+    raise RuntimeError("crism not found in the -X importtime output")
+
+def command_time_ms():
+    """Returns the wall clock time of running a trivial crism.py command."""
+    start = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(SCRIPTDIR, "crism.py"), "mtrdr_source_bands", "[380,780]"],
+                   capture_output=True, check=True)
+    return (time.perf_counter() - start) * 1000
+
+def eager_modules():
+    """Returns the heavy modules imported by "import crism"."""
+    check = "import crism, sys; print(' '.join(m for m in " + repr(LAZY_MODULES) + " if m in sys.modules))"
+    result = subprocess.run([sys.executable, "-c", check], cwd=SCRIPTDIR, capture_output=True, text=True, check=True)
+    return result.stdout.split()
+
+def main(runs=5):
+    #Take the best of several runs to filter out noise from the rest of the system
+    import_ms = min(import_time_ms() for run in range(runs))
+    command_ms = min(command_time_ms() for run in range(runs))
+    eager = eager_modules()
+
+    print("import crism:          %6.1f ms (budget %d ms)" % (import_ms, IMPORT_BUDGET_MS))
+    print("crism.py command:      %6.1f ms (budget %d ms)" % (command_ms, COMMAND_BUDGET_MS))
+    print("eagerly imported:      " + (", ".join(eager) if eager else "none"))
+
+    failed = import_ms > IMPORT_BUDGET_MS or command_ms > COMMAND_BUDGET_MS or eager
+    print("FAILED" if failed else "OK")
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    runs = 5
+    for arg in sys.argv[1:]:
+        if arg.startswith("--runs="):
+            runs = int(arg[len("--runs="):])
+    sys.exit(main(runs))
@@ -0,0 +1,146 @@
+# Crash recovery check for the work queue of crism.py worker.
+#
+# Writes a few small synthetic MTRDR cubes into a temporary directory tree, plants the claim
+# of a killed worker on one of them, as if it had died while rendering, and starts several
+# crism.py worker processes on the tree at once, calibrated with the example snow spectrum.
+# Checks that every image is rendered exactly once, by one worker, that the stale claim is
+# taken over by one of the workers and that the queue is left without claims and without
+# heartbeat files of the workers.
+#
+# Usage:
+# python3 check_worker_queue.py [--workers=N] [--images=N]
+#
+# Exits with status 1 if a check fails.
+
+import glob
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+#Short heartbeat and stale times, so that the check takes seconds instead of minutes
+HEARTBEAT = 1
+STALE = 5
+
+SCRIPTDIR = os.path.dirname(os.path.abspath(__file__))
+WHITEFLAT = os.path.join(SCRIPTDIR, "frt000128f3_07_if165j_mtr3_spectrum_snow.csv")
+
+def write_cubes(directory, images):
+    """Writes small synthetic MTRDR cubes in ENVI format into subdirectories of directory and
+    returns their file names."""
+    import numpy as np
+    import rasterio
+    from rasterio.transform import from_origin
+
+    rng = np.random.default_rng(0)
+    height, width, bands = 24, 20, 489
+    wavelengths = np.linspace(436, 1000, bands)[:,None,None]
+    profile = dict(driver="ENVI", width=width, height=height, count=bands, dtype="float32",
+                   crs="EPSG:4326", transform=from_origin(10, 20, 0.001, 0.001))
+    files = []
+    for image in range(images):
+        albedo = 0.1 + 0.2*rng.random((1, height, width))
+        cube = (albedo*(0.5 + wavelengths/2000) + 0.01*rng.random((bands, height, width))).astype("float32")
+        os.makedirs(os.path.join(directory, "orbit%d" % (image % 2)), exist_ok=True)
+        file = os.path.join(directory, "orbit%d" % (image % 2), "frt%08x_07_if165j_mtr3.img" % image)
+        with rasterio.open(file, "w", **profile) as dst:
+            dst.write(cube)
+        files.append(file)
+    return files
+
+def plant_stale_claim(queue, key):
+    """Leaves the claim and the heartbeat file of a worker killed while rendering an image, last
+    refreshed an hour ago, and returns the id of the dead worker."""
+    dead = "crashed-host-999999"
+    for name in ("claims", "done", "failed", "workers"):
+        os.makedirs(os.path.join(queue, name), exist_ok=True)
+    claim = os.path.join(queue, "claims", key+".claim")
+    with open(claim, "w") as out:
+        json.dump(dict(token=dead+"-0", worker=dead, host="crashed-host", pid=999999, claimed=0), out)
+    heartbeat = os.path.join(queue, "workers", dead)
+    with open(heartbeat, "w"):
+        pass
+    past = time.time() - 3600
+    for path in (claim, heartbeat):
+        os.utime(path, (past, past))
+    return dead
+
+def run_workers(directory, workers):
+    """Starts the workers at once in directory, where they find mtrdr_whiteflat.csv, and returns
+    their outputs when all of them have finished."""
+    command = [sys.executable, os.path.join(SCRIPTDIR, "crism.py"), "worker", "--directory="+directory,
+               "--product=mtrdr_to_color", "--pattern=*if*mtr3*img",
+               "--heartbeat="+str(HEARTBEAT), "--stale="+str(STALE)]
+    processes = [subprocess.Popen(command, cwd=directory, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+                 for worker in range(workers)]
+    return [process.communicate()[0] for process in processes]
+
+def main(workers=4, images=6):
+    directory = tempfile.mkdtemp(prefix="crism-queue-")
+    try:
+        files = write_cubes(directory, images)
+        shutil.copy(WHITEFLAT, os.path.join(directory, "mtrdr_whiteflat.csv"))
+        queue = os.path.join(directory, ".crism-queue")
+        stale_key = os.path.relpath(files[0], directory).replace("%", "%25").replace(os.sep, "%2F")
+        dead = plant_stale_claim(queue, stale_key)
+
+        start = time.perf_counter()
+        outputs = run_workers(directory, workers)
+        elapsed = time.perf_counter() - start
+        output = "\n".join(outputs)
+
+        failures = []
+        for file in files:
+            key = os.path.relpath(file, directory).replace("%", "%25").replace(os.sep, "%2F")
+            renders = len(re.findall(r" processing "+re.escape(file)+r"\.\.\.$", output, re.MULTILINE))
+            if renders != 1:
+                failures.append("%s rendered %d times" % (file, renders))
+            try:
+                with open(os.path.join(queue, "done", key+".json")) as record:
+                    record = json.load(record)
+            except (OSError, ValueError):
+                failures.append("no done record for "+file)
+                continue
+            if record["error"] is not None or not record["outputs"]:
+                failures.append("%s has no outputs: %s" % (file, record["error"]))
+            if record["worker"] == dead:
+                failures.append(file+" is recorded as done by the dead worker")
+
+        reclaims = output.count("reclaimed the stale claim "+stale_key+".claim")
+        if reclaims != 1:
+            failures.append("the stale claim was reclaimed %d times" % reclaims)
+        failed = glob.glob(os.path.join(queue, "failed", "*.json"))
+        if failed:
+            failures.append("%d failed records" % len(failed))
+        left = os.listdir(os.path.join(queue, "claims"))
+        if left:
+            failures.append("claims left in the queue: "+", ".join(left))
+        left = [name for name in os.listdir(os.path.join(queue, "workers")) if name != dead]
+        if left:
+            failures.append("heartbeat files left in the queue: "+", ".join(left))
+
+        print("workers:               %6d" % workers)
+        print("images:                %6d" % images)
+        print("elapsed:               %6.1f s" % elapsed)
+        for failure in failures:
+            print("Error: "+failure)
+        if failures:
+            print(output)
+        print("FAILED" if failures else "OK")
+        return 1 if failures else 0
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == '__main__':
+    workers = 4
+    images = 6
+    for arg in sys.argv[1:]:
+        if arg.startswith("--workers="):
+            workers = int(arg[len("--workers="):])
+        elif arg.startswith("--images="):
+            images = int(arg[len("--images="):])
+    sys.exit(main(workers, images))
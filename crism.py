@@ -24,10 +24,34 @@
 #
 # This calibration is not yet complete, but already shows an improvement in the expected direction.
 
-import rasterio
+import collections
+import copy
+import functools
+import glob
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
-import spectres as spec
-import fire
+
+#rasterio (GDAL), spectres, fire, zarr, http.server and socketserver are imported by the functions using them,
+#and the matching function tables are loaded on first use, so that starting crism.py and
+#printing --help stay fast. bench_startup.py keeps track of the startup time.
+
+#Directory of the instrument response and color matching tables, next to crism.py
+MATCHING_FUNCTIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "matching_functions")
+
+@functools.lru_cache(maxsize=None)
+def load_table(name, delimiter=None, usecols=None):
+    """Loads a table from the matching_functions directory once and returns it read-only."""
+    table = np.genfromtxt(os.path.join(MATCHING_FUNCTIONS, name), delimiter=delimiter, usecols=usecols)
+    table.flags.writeable = False
+    return table
 
 #Initialize color_system.py (this segment of code by 'christian' on the SciPython blog)
 #See: https://scipython.com/blog/converting-a-spectrum-to-a-colour/
@@ -43,8 +67,9 @@ class ColourSystem:
     A colour system defined by the CIE x, y and z=1-x-y coordinates of
     its three primary illuminants and its "white point"."""
 
-    # The CIE colour matching function for 380 - 780 nm in 5 nm intervals
-    cmf = np.loadtxt('matching_functions/cie-cmf.txt', usecols=(1,2,3))
+    # The CIE colour matching function for 380 - 780 nm in 5 nm intervals,
+    # loaded on first use by colour_matching()
+    cmf = None
 
     def __init__(self, red, green, blue, white):
         """Initialise the ColourSystem object.
@@ -64,6 +89,24 @@ class ColourSystem:
         # xyz -> rgb transformation matrix
         self.T = self.MI / self.wscale[:, np.newaxis]
 
+    def colour_matching(self):
+        """Return the colour matching function, self.cmf, loading the CIE
+        colour matching function if none has been set."""
+
+        if self.cmf is None:
+            ColourSystem.cmf = load_table("cie-cmf.txt", usecols=(1,2,3))
+        return self.cmf
+
+    def with_colour_matching(self, cmf):
+        """Return a copy of the colour system using the colour matching function cmf.
+
+        The shared colour systems and the class-wide default stay unchanged, so
+        renders of different wavelength ranges can run in parallel threads."""
+
+        cs = copy.copy(self)
+        cs.cmf = cmf
+        return cs
+
     def xyz_to_rgb(self, xyz, out_fmt=None):
         """Transform from xyz to rgb representation of colour.
 
@@ -85,7 +128,7 @@ class ColourSystem:
         The spectrum must be on the same grid of points as the colour-matching
         function, self.cmf: 380-780 nm in 5 nm steps."""
 
-        XYZ = np.sum(spec[:, np.newaxis] * self.cmf, axis=0)
+        XYZ = np.sum(spec[:, np.newaxis] * self.colour_matching(), axis=0)
         den = np.sum(XYZ)
         if den == 0.:
             return XYZ
@@ -97,24 +140,58 @@ class ColourSystem:
         xyz = self.spec_to_xyz(spec)
         return self.xyz_to_rgb(xyz, out_fmt)
 
+    def spectra_to_rgb(self, spectra):
+        """Convert an array of spectra, shape (pixels, bands), to rgb values.
+
+        Gives the same result as spec_to_rgb() on every spectrum, but
+        converts all of them at once with matrix products."""
+
+        return self.tristimulus_to_rgb(spectra.dot(self.colour_matching()))
+
+    def tristimulus_to_rgb(self, XYZ):
+        """Convert an array of XYZ tristimulus values, shape (pixels, 3), to rgb
+        values, as spectra_to_rgb() does after integrating the spectra."""
+
+        den = np.sum(XYZ, axis=1)[:, np.newaxis]
+        xyz = np.divide(XYZ, den, out=XYZ.copy(), where=den != 0.)
+        rgb = xyz.dot(self.T.T)
+        # Desaturate the pixels out of the RGB gamut
+        rgb += np.maximum(-np.min(rgb, axis=1), 0)[:, np.newaxis]
+        return rgb
+
 illuminant_D50 = xyz_from_xy(0.3457, 0.3585)
 illuminant_D55 = xyz_from_xy(0.3324, 0.3474)
 illuminant_D65 = xyz_from_xy(0.3127, 0.3291)
 illuminant_D75 = xyz_from_xy(0.2990, 0.3149)
-cs_hdtv = ColourSystem(red=xyz_from_xy(0.67, 0.33),
-                       green=xyz_from_xy(0.21, 0.71),
-                       blue=xyz_from_xy(0.15, 0.06),
-                       white=illuminant_D55)
 
-cs_smpte = ColourSystem(red=xyz_from_xy(0.63, 0.34),
-                        green=xyz_from_xy(0.31, 0.595),
-                        blue=xyz_from_xy(0.155, 0.070),
-                        white=illuminant_D55)
+@functools.lru_cache(maxsize=None)
+def colour_system(name):
+    """Return one of the colour systems "hdtv", "smpte" or "srgb", created on first use."""
+    if name == "hdtv":
+        return ColourSystem(red=xyz_from_xy(0.67, 0.33),
+                            green=xyz_from_xy(0.21, 0.71),
+                            blue=xyz_from_xy(0.15, 0.06),
+                            white=illuminant_D55)
+
+    if name == "smpte":
+        return ColourSystem(red=xyz_from_xy(0.63, 0.34),
+                            green=xyz_from_xy(0.31, 0.595),
+                            blue=xyz_from_xy(0.155, 0.070),
+                            white=illuminant_D55)
 
-cs_srgb = ColourSystem(red=xyz_from_xy(0.64, 0.33),
-                       green=xyz_from_xy(0.30, 0.60),
-                       blue=xyz_from_xy(0.15, 0.06),
-                       white=illuminant_D55)
+    if name == "srgb":
+        return ColourSystem(red=xyz_from_xy(0.64, 0.33),
+                            green=xyz_from_xy(0.30, 0.60),
+                            blue=xyz_from_xy(0.15, 0.06),
+                            white=illuminant_D55)
+
+    raise ValueError("Invalid colour system '"+str(name)+"', use 'hdtv', 'smpte' or 'srgb'.")
+
+def __getattr__(name):
+    """Keep crism.cs_hdtv, crism.cs_smpte and crism.cs_srgb available as module attributes."""
+    if name in ("cs_hdtv", "cs_smpte", "cs_srgb"):
+        return colour_system(name[3:])
+    raise AttributeError("module 'crism' has no attribute '"+name+"'")
 
 
 ##Defining a few internal functions to help us on our journey.
@@ -130,21 +207,13 @@ def quicknorm(data):
     data = (data-np.amin(data))/np.amax(data)
     return data
 
-def calculate_luminance(weights, cube):
-    """Function to calculate an image through a filter given the filter transmission properties
-    (weights) from a cube."""
-    ##Design philosophy: I am integrating the filter bandpass by first multiplying each cube channel
-    #by the filter transmission at that channel, then summing the result. To maintain the relative 
-    #brighnesses of each filter, I then find the average I/F value for the wavelength range spanned by
-    #the cube, and then add an offset value to the calculated filter.
-    
-    #This is mostly to make sure that the weights work for low transmission filters. Setup for later
-    #before we modify the weights variable for filter integration.
+def filter_band_range(weights):
+    """Returns the first and last band index where a filter transmits (weights >= 5%)."""
+    #This is mostly to make sure that the weights work for low transmission filters.
     if np.amax(weights) < 0.05:
         weights = weights * 100
         short = np.where(weights >= 0.05)[0][0]
         long = np.where(weights >= 0.05)[0][-1]
-        weights = weights / 100
     
     else:
         short = np.where(weights >= 0.05)[0][0]
@@ -153,25 +222,508 @@ def calculate_luminance(weights, cube):
     if short == long:
         long += 1      
     
+    return(short, long)
+
+def calculate_luminance(weights, cube, offset=None):
+    """Function to calculate an image through a filter given the filter transmission properties
+    (weights) from a cube. A precomputed offset (see luminance_offset()) can be passed when
+    only part of a scene is in the cube."""
+    ##Design philosophy: I am integrating the filter bandpass by first multiplying each cube channel
+    #by the filter transmission at that channel, then summing the result. To maintain the relative 
+    #brighnesses of each filter, I then find the average I/F value for the wavelength range spanned by
+    #the cube, and then add an offset value to the calculated filter.
+    short, long = filter_band_range(weights)
+    
     #Now integrate the filter
     weights = weights/np.sum(weights)
     lumin = np.average(cube, axis=2, weights=weights)
     
     #Apply offset to "true" I/F
-    lumin += (np.mean(cube[:,:,short:long]) - np.mean(lumin))
+    if offset is None:
+        offset = np.mean(cube[:,:,short:long]) - np.mean(lumin)
+    lumin += offset
 
     return(lumin)
 
+def luminance_offset(weights, band_means):
+    """Returns the offset calculate_luminance() adds to a filter image, computed from the
+    mean value of every band of the cube instead of from the full cube."""
+    short, long = filter_band_range(weights)
+    weights = weights/np.sum(weights)
+    return np.mean(band_means[short:long]) - np.dot(band_means, weights)
+
 def convert_uint16(cube):
     """Converts cube data (float format) to 16-bit unsigned integer."""
     cube = cube * 65535
     cube = cube.astype(np.uint16)
     return(cube)
 
+#Rows per block written by write_raster() and rendered by MtrdrScene.color_rows()
+BLOCK_ROWS = 256
+
+#Stretch statistics
+
+#Number of histogram bins of StreamStatistics, as many as a 16-bit image has levels
+STATISTICS_BINS = 65536
+
+class StreamStatistics:
+    """Statistics of a stream of value blocks gathered in a single pass: count, minimum,
+    maximum and a fixed-size histogram from which percentiles are estimated.
+
+    The bins have a power of two width on a grid anchored at 0. Whenever new values don't fit
+    into the histogram anymore, the width is doubled until they do, so percentiles are exact
+    to within about (max - min) / bins. Statistics of different parts of a scene, gathered by
+    other threads or processes, are combined with merge(). With bins=0 only the count, the
+    minimum and the maximum are kept, which is much faster."""
+
+    def __init__(self, bins=STATISTICS_BINS):
+        self.bins = bins
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self.width = None
+        self.start = 0
+        self.counts = np.zeros(bins, dtype=np.int64)
+
+    def add(self, values):
+        """Add an array of values of any shape. Masked, NaN and infinite values are skipped."""
+        values = np.ma.compressed(values) if np.ma.isMaskedArray(values) else np.ravel(values)
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            return self
+        low = np.amin(values)
+        high = np.amax(values)
+        if self.bins:
+            self._cover(min(low, self.min), max(high, self.max))
+            index = np.floor(values / self.width).astype(np.int64) - self.start
+            self.counts += np.bincount(index, minlength=self.bins)
+        self.count += len(values)
+        self.min = min(low, self.min)
+        self.max = max(high, self.max)
+        return self
+
+    def merge(self, other):
+        """Add the values gathered by other."""
+        if other.count == 0:
+            return self
+        if self.bins:
+            if not other.bins:
+                raise ValueError("Can't merge statistics without a histogram into ones with a histogram.")
+            self._cover(min(other.min, self.min), max(other.max, self.max), other.width)
+            self.counts += self._rebin(other.counts, other.start, other.width)
+        self.count += other.count
+        self.min = min(other.min, self.min)
+        self.max = max(other.max, self.max)
+        return self
+
+    def percentile(self, q):
+        """Returns an estimate of the q-th percentile (0 to 100) of the values, interpolated
+        within its bin. The 0th and 100th percentiles are the exact minimum and maximum."""
+        if self.count == 0:
+            return np.nan
+        if q <= 0:
+            return self.min
+        if q >= 100:
+            return self.max
+        if not self.bins:
+            raise ValueError("Percentiles need statistics with a histogram.")
+        rank = q / 100 * self.count
+        cumulative = np.cumsum(self.counts)
+        index = int(np.searchsorted(cumulative, rank))
+        fraction = (rank - (cumulative[index] - self.counts[index])) / self.counts[index]
+        return np.clip((self.start + index + fraction) * self.width, self.min, self.max)
+
+    def stretch_range(self, percentile=None):
+        """Returns the (low, high) limits of a contrast stretch: the minimum and maximum, or the
+        percentile-th and (100 - percentile)-th percentiles."""
+        if percentile is None:
+            return self.min, self.max
+        return self.percentile(percentile), self.percentile(100 - percentile)
+
+    def _cover(self, low, high, width=None):
+        #Widen the bins until [low, high] fits into the histogram and move the counts over
+        new_width = max(self.width or 0, width or 0)
+        if new_width == 0:
+            span = (high - low) / (self.bins - 1)
+            #A single value gives no scale, start narrow and let the doubling below widen
+            #the bins as needed
+            if span == 0:
+                span = abs(low) * 2.0**-20 or 2.0**-64
+            new_width = 2.0**np.ceil(np.log2(span))
+        while np.floor(high / new_width) - np.floor(low / new_width) >= self.bins:
+            new_width *= 2
+        old = (self.counts, self.start, self.width)
+        self.start = int(np.floor(low / new_width))
+        self.width = new_width
+        if old[2] is not None:
+            self.counts = self._rebin(*old)
+
+    def _rebin(self, counts, start, width):
+        #Returns histogram counts with a finer or equal bin width on the bins of this histogram
+        factor = int(round(self.width / width))
+        used = np.nonzero(counts)[0]
+        index = (start + used) // factor - self.start
+        rebinned = np.zeros(self.bins, dtype=np.int64)
+        np.add.at(rebinned, index, counts[used])
+        return rebinned
+
+def sample_pixels(cube, sample, rng):
+    """Returns a random spatial subsample of about a fraction sample of the pixels of a cube
+    with the wavelength axis last, as an array of spectra of shape (pixels, bands)."""
+    spectra = cube.reshape(-1, cube.shape[-1])
+    if sample >= 1:
+        return spectra
+    return spectra[rng.random(len(spectra)) < sample]
+
+def export_stretch(channels, percentile=None, sample=1, seed=0, block_rows=BLOCK_ROWS):
+    """Returns the (low, high) stretch limits of the filter product exports over all channel
+    images in one pass of StreamStatistics: the minimum and maximum, or with percentile the
+    percentile-th and (100 - percentile)-th percentiles. With sample below 1, the statistics
+    are taken from that random fraction of the pixels. Percentiles skip the masked null
+    pixels of the channels, the minimum and maximum count them with their fill value as the
+    exports always have."""
+    statistics = StreamStatistics(0 if percentile is None else STATISTICS_BINS)
+    rng = np.random.default_rng(seed)
+    for row in range(0, channels[0].shape[0], block_rows):
+        blocks = [channel[row:row + block_rows] for channel in channels]
+        if percentile is None:
+            blocks = [np.asarray(block) for block in blocks]
+        if sample >= 1:
+            for block in blocks:
+                statistics.add(block)
+        else:
+            statistics.add(sample_pixels(np.ma.stack(blocks, axis=-1), sample, rng))
+    return statistics.stretch_range(percentile)
+
+def stretch_rows(channels, stretch, percentile=None, block_rows=BLOCK_ROWS):
+    """Yields the channel images stacked band-first as uint16 row blocks, stretched between the
+    (low, high) limits of export_stretch() with 2% margins like the filter product exports.
+    With percentile, the limits are percentiles and are mapped onto 0 and 1 instead, so that
+    the values beyond them saturate. Only one block of the stacked export is held in memory
+    at a time."""
+    low, high = stretch
+    for row in range(0, channels[0].shape[0], block_rows):
+        export = np.stack([channel[row:row + block_rows] for channel in channels])
+        if percentile is None:
+            export = (export - (low - (0.02*low))) / ((high + (0.02*high)))
+        else:
+            export = (export - low) / (high - low)
+        #Percentile stretches leave values outside of [0, 1], clip instead of letting the
+        #integer conversion wrap around
+        yield convert_uint16(np.clip(export, 0, 1))
+
+def image_rows(image, block_rows=BLOCK_ROWS):
+    """Yields a single-band image as uint16 row blocks of shape (1, rows, width)."""
+    for row in range(0, image.shape[0], block_rows):
+        yield convert_uint16(np.expand_dims(image[row:row + block_rows], 0))
+
+#Output functions
+
+#Output formats: file extension and GDAL driver with creation options. PNG output is
+#written single-threaded and drops the map projection; "cog" writes a tiled, deflate
+#compressed Cloud Optimized GeoTIFF with internal overviews that keeps the CRS and
+#geotransform of the input cube and compresses with all CPU cores.
+OUTPUT_FORMATS = {
+    "png": (".png", dict(driver='PNG')),
+    "cog": (".tif", dict(driver='COG', compress='deflate', predictor=2, blocksize=512,
+                         overviews='auto', resampling='average', num_threads='all_cpus',
+                         bigtiff='if_safer')),
+}
+
+def output_extension(fmt):
+    """Returns the file extension of an output format."""
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError("Invalid output format '"+str(fmt)+"', use one of: "+", ".join(OUTPUT_FORMATS))
+    return OUTPUT_FORMATS[fmt][0]
+
+def output_options(fmt):
+    """Returns the driver and creation options of an output format for profile.update()."""
+    output_extension(fmt)
+    return dict(OUTPUT_FORMATS[fmt][1])
+
+#PNG color types by number of bands: gray, gray and alpha, RGB, RGBA
+PNG_COLOR_TYPES = {1: 0, 2: 4, 3: 2, 4: 6}
+
+def _png_chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+def png_filter_rows(rows, previous, bpp):
+    """Returns PNG scanlines with the Paeth filter of a block of image rows given as bytes, shape
+    (rows, row bytes). previous is the last unfiltered row above the block (zeros for the first
+    block) and bpp the bytes per pixel."""
+    rows = rows.astype(np.int16)
+    up = np.vstack((previous[np.newaxis].astype(np.int16), rows[:-1]))
+    left = np.zeros_like(rows)
+    left[:, bpp:] = rows[:, :-bpp]
+    upleft = np.zeros_like(up)
+    upleft[:, bpp:] = up[:, :-bpp]
+    estimate = left + up - upleft
+    pa = np.abs(estimate - left)
+    pb = np.abs(estimate - up)
+    pc = np.abs(estimate - upleft)
+    predictor = np.where((pa <= pb) & (pa <= pc), left, np.where(pb <= pc, up, upleft))
+    filtered = ((rows - predictor) & 0xff).astype(np.uint8)
+    return np.hstack((np.full((len(rows), 1), 4, dtype=np.uint8), filtered))
+
+class RasterStream:
+    """Writes a raster file from row blocks, top to bottom, so that the full image never has
+    to be in memory.
+
+    The GDAL PNG and COG drivers can only copy a complete image, which rasterio keeps in an
+    in-memory dataset until the file is closed. PNG files are therefore written by a
+    streaming encoder here, with the georeference in a .aux.xml file as GDAL writes it. COG
+    files are assembled from windowed writes into a temporary tiled GeoTIFF, which GDAL
+    copies block by block into the Cloud Optimized GeoTIFF at close(). Other drivers get
+    windowed writes directly."""
+
+    def __init__(self, path, profile):
+        import rasterio
+        self.path = path
+        self.profile = dict(profile)
+        self.width = profile["width"]
+        self.height = profile["height"]
+        self.count = profile["count"]
+        self.row = 0
+        self.driver = profile["driver"]
+
+        if self.driver == "PNG":
+            depth = {"uint8": 8, "uint16": 16}.get(np.dtype(profile["dtype"]).name)
+            if depth is None or self.count not in PNG_COLOR_TYPES:
+                raise ValueError("PNG output needs 1 to 4 bands of uint8 or uint16 data.")
+            self.dtype = np.dtype(">u2") if depth == 16 else np.dtype("u1")
+            self.previous = np.zeros(self.width * self.count * self.dtype.itemsize, dtype=np.uint8)
+            self.compressor = zlib.compressobj(6)
+            self.pending = bytearray()
+            self.out = open(path, "wb")
+            self.out.write(b"\x89PNG\r\n\x1a\n")
+            self.out.write(_png_chunk(b"IHDR", struct.pack(">IIBBBBB", self.width, self.height, depth,
+                                                           PNG_COLOR_TYPES[self.count], 0, 0, 0)))
+            #Gray and RGB images mark nodata pixels as transparent, as GDAL does. Images with
+            #an alpha band only get the nodata value in the .aux.xml file.
+            if self.count in (1, 3) and self._png_nodata(depth) is not None:
+                self.out.write(_png_chunk(b"tRNS", struct.pack(">"+"H"*self.count, *[self._png_nodata(depth)]*self.count)))
+            return
+
+        self.target = path
+        if self.driver == "COG":
+            self.target = path+".part.tif"
+            tiled = dict(driver="GTiff", width=self.width, height=self.height, count=self.count,
+                         dtype=profile["dtype"], crs=profile.get("crs"), transform=profile.get("transform"),
+                         nodata=profile.get("nodata"), tiled=True, blockxsize=512, blockysize=512,
+                         compress="deflate", zlevel=1, bigtiff="if_safer")
+            self.out = rasterio.open(self.target, "w", **tiled)
+        else:
+            self.out = rasterio.open(path, "w", **profile)
+
+    def write(self, block):
+        """Write the next rows, a band-first array of shape (count, rows, width)."""
+        if block.shape[0] != self.count or block.shape[2] != self.width or self.row + block.shape[1] > self.height:
+            raise ValueError("Row block of shape "+str(block.shape)+" doesn't fit the image at row "+str(self.row)+".")
+        if np.ma.isMaskedArray(block):
+            #Masked pixels get the nodata value, or the fill value of the array, as rasterio does
+            block = block.filled(self.profile.get("nodata"))
+        if self.driver == "PNG":
+            rows = np.ascontiguousarray(block.transpose(1, 2, 0), dtype=self.dtype)
+            rows = rows.view(np.uint8).reshape(block.shape[1], -1)
+            self.pending += self.compressor.compress(png_filter_rows(rows, self.previous, self.count * self.dtype.itemsize).tobytes())
+            self.previous = rows[-1].copy()
+            if len(self.pending) >= 1 << 20:
+                self.out.write(_png_chunk(b"IDAT", bytes(self.pending)))
+                self.pending = bytearray()
+        else:
+            import rasterio
+            self.out.write(block, window=rasterio.windows.Window(0, self.row, self.width, block.shape[1]))
+        self.row += block.shape[1]
+
+    def close(self):
+        """Finish the file. All rows must have been written."""
+        if self.row != self.height:
+            raise ValueError("Only "+str(self.row)+" of "+str(self.height)+" rows were written to "+self.path+".")
+        if self.driver == "PNG":
+            self.pending += self.compressor.flush()
+            self.out.write(_png_chunk(b"IDAT", bytes(self.pending)))
+            self.out.write(_png_chunk(b"IEND", b""))
+            self.out.close()
+            self._write_georeference()
+            return
+        self.out.close()
+        if self.driver == "COG":
+            import rasterio.shutil
+            options = {key: self.profile[key] for key in OUTPUT_FORMATS["cog"][1] if key != "driver" and key in self.profile}
+            rasterio.shutil.copy(self.target, self.path, driver="COG", **options)
+            os.remove(self.target)
+
+    def abort(self):
+        """Close and remove the unfinished file."""
+        self.out.close()
+        for path in (self.path, self.target if self.driver != "PNG" else None):
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+
+    def _png_nodata(self, depth):
+        """Returns the nodata value of the profile if a PNG sample can hold it, otherwise None."""
+        nodata = self.profile.get("nodata")
+        if nodata is None or nodata != int(nodata) or not 0 <= nodata < 1 << depth:
+            return None
+        return int(nodata)
+
+    def _write_georeference(self):
+        import rasterio
+        crs = self.profile.get("crs")
+        transform = self.profile.get("transform")
+        nodata = self._png_nodata(8 * self.dtype.itemsize)
+        if crs is None and (transform is None or transform.is_identity) and nodata is None:
+            return
+        lines = ["<PAMDataset>"]
+        if crs is not None:
+            wkt = rasterio.crs.CRS.from_user_input(crs).to_wkt()
+            wkt = wkt.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+            lines.append("  <SRS>"+wkt+"</SRS>")
+        if transform is not None and not transform.is_identity:
+            lines.append("  <GeoTransform>"+", ".join("%.16e" % value for value in transform.to_gdal())+"</GeoTransform>")
+        if nodata is not None and self.count == 3:
+            lines += ["  <Metadata>", '    <MDI key="NODATA_VALUES">'+" ".join([str(nodata)]*3)+"</MDI>", "  </Metadata>"]
+        elif nodata is not None and self.count in (2, 4):
+            for band in range(1, self.count + 1):
+                lines += ['  <PAMRasterBand band="'+str(band)+'">', "    <NoDataValue>%.14E</NoDataValue>" % nodata, "  </PAMRasterBand>"]
+        lines.append("</PAMDataset>")
+        with open(self.path+".aux.xml", "w") as out:
+            out.write("\n".join(lines)+"\n")
+
+#Render job of serve_renders() running in the current thread, None elsewhere. Reads and
+#writes check it for cancellation and written files are counted as its progress.
+_render_job = threading.local()
+
+def _current_job():
+    """Returns the serve_renders() job rendered by the calling thread, or None."""
+    return getattr(_render_job, "job", None)
+
+def write_raster(path, profile, data, job=None):
+    """Writes a band-first array, or an iterable of band-first row blocks from top to bottom,
+    to the raster file described by profile through a RasterStream.
+
+    job is the render job the file belongs to, by default the one of the calling thread."""
+    job = job or _current_job()
+    blocks = data
+    if isinstance(data, np.ndarray):
+        blocks = (data[:, row:row + BLOCK_ROWS] for row in range(0, data.shape[1], BLOCK_ROWS))
+    if job is not None:
+        job.checkpoint()
+    stream = RasterStream(path, profile)
+    try:
+        for block in blocks:
+            if job is not None:
+                job.checkpoint()
+            stream.write(block)
+        stream.close()
+    except BaseException:
+        stream.abort()
+        raise
+    if job is not None:
+        job.written(path)
+
+class AsyncWriter:
+    """Background writer encoding and writing output images on a thread pool.
+
+    Products with many single-band outputs hand each finished image to submit() and
+    go on computing the next filter image while the previous ones are compressed and
+    written. At most queue_depth images are pending at once, so submit() blocks when
+    the queue is full to cap memory. Images may also be submitted as iterables of row
+    blocks, see write_raster(), which are then produced on the writer thread. The first
+    write error is re-raised by submit() or close(), whichever comes first.
+
+    Used as a context manager, the writer is closed at the end of the block. If the block
+    raises, the pending writes are cancelled and the running ones are waited for instead, so
+    no file is written after the caller has failed."""
+
+    def __init__(self, queue_depth=4, workers=2):
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(max(1, queue_depth))
+        self.futures = []
+
+    def submit(self, path, profile, data):
+        """Queue data for writing to path. The profile is copied, so callers can keep
+        updating their own profile for the next output."""
+        self.check()
+        job = _current_job()
+        if job is not None:
+            job.checkpoint()
+        self.slots.acquire()
+        try:
+            future = self.pool.submit(write_raster, path, dict(profile), data, job)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda f: self.slots.release())
+        self.futures.append(future)
+
+    def check(self):
+        """Raise the first error of the writes finished so far."""
+        for future in self.futures:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+
+    def close(self):
+        """Wait for all pending writes and raise the first write error, if any."""
+        self.pool.shutdown(wait=True)
+        for future in self.futures:
+            if future.exception() is not None:
+                raise future.exception()
+
+    def abort(self):
+        """Cancel the pending writes and wait for the running ones. Their errors are printed,
+        as the error which caused the abort is the one to raise."""
+        self.pool.shutdown(wait=True, cancel_futures=True)
+        for future in self.futures:
+            if not future.cancelled() and future.exception() is not None:
+                print("Error: "+str(future.exception()))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+#MTRDR input functions
+
+#Cubes loaded ahead of time by mtrdr_batch(), keyed by file name
+_prefetched = {}
+_prefetched_lock = threading.Lock()
+
+def load_mtrdr(file, bands=None):
+    """Reads the raster profile and the data cube of an MTRDR image, only its leading `bands`
+    bands if given."""
+    import rasterio
+    with rasterio.open(file) as src:
+        profile = src.profile
+        cube = src.read(None if bands is None else list(range(1, min(bands, src.count) + 1)))
+    return profile, cube
+
+def read_mtrdr(file, bands=None):
+    """Returns the raster profile and data cube of an MTRDR image, or its leading `bands` bands,
+    taking the cube prefetched by mtrdr_batch() if there is one with enough bands."""
+    with _prefetched_lock:
+        loaded = _prefetched.pop(file, None)
+    if loaded is not None:
+        profile, cube = loaded
+        needed = profile["count"] if bands is None else min(bands, profile["count"])
+        if cube.shape[0] >= needed:
+            return profile, cube[:needed]
+    loaded = load_mtrdr(file, bands)
+    job = _current_job()
+    if job is not None:
+        job.checkpoint()
+    return loaded
+
 #MTRDR pre-processing functions
+@functools.lru_cache(maxsize=None)
 def modify_mtrdr_axis():
-    """Crops the image cube to the given wavelength range."""
-    mtrdr_axis = np.genfromtxt("matching_functions/mtrdr_axis.tab", delimiter=",")
+    """Returns the MTRDR wavelength axis with the gaps filled in by format_mtrdr().
+    The axis is computed once and returned read-only."""
+    mtrdr_axis = load_table("mtrdr_axis.tab", delimiter=",")
     mtrdr_axis = mtrdr_axis[:,2]
     
     #Fill in the gaps where bad bands are present
@@ -184,9 +736,32 @@ def modify_mtrdr_axis():
     bad_band_fill = np.linspace(637.96, 703.1, num=10)
     bad_band_fill = np.around(bad_band_fill, decimals=2)
     mtrdr_axis = np.insert(mtrdr_axis, 40, bad_band_fill, axis=0)
+    mtrdr_axis.flags.writeable = False
     
     return(mtrdr_axis)
 
+def mtrdr_source_bands(wave_list):
+    """Returns how many leading bands of an MTRDR cube are needed to fill and crop it to the
+    given wavelength range, so that only those have to be read from disk."""
+    mtrdr_axis = modify_mtrdr_axis()
+    long = find_band(mtrdr_axis, wave_list[1])
+    
+    #format_mtrdr() inserts 9 blue and 10 VIS-NIR bands, and uses the first 34 bands of the
+    #original cube for the extrapolation.
+    return(max(long - 19, 34))
+
+#The widest wavelength range of the built-in products
+PRODUCT_WAVE_RANGE = (380, 1200)
+
+def mtrdr_product_bands(wave_list=None):
+    """Returns how many leading bands of an MTRDR cube are read for a product of the given
+    wavelength range: those needed for PRODUCT_WAVE_RANGE, so that all built-in products of a
+    scene share one read, or more for wider ranges."""
+    bands = mtrdr_source_bands(PRODUCT_WAVE_RANGE)
+    if wave_list is not None:
+        bands = max(bands, mtrdr_source_bands(wave_list))
+    return int(bands)
+
 def mtrdr_crop_bands(image_cube, wave_list):
     """Crops the image cube to the given wavelength range."""
     mtrdr_axis = modify_mtrdr_axis()
@@ -198,11 +773,19 @@ def mtrdr_crop_bands(image_cube, wave_list):
     return(crop_cube)
     
 def mtrdr_color_matching(wave_list):
-    """Adjusts the CIE color matching function to span the given wavelength range."""
+    """Adjusts the CIE color matching function to span the given wavelength range.
+
+    The result is computed once per range and returned read-only."""
+    return _color_matching(tuple(wave_list))
+
+@functools.lru_cache(maxsize=None)
+def _color_matching(wave_list):
+    import spectres as spec
+
     #Import CIE color matching function
     #Index 0 - wavelengths, Index 1 - red matching function
     #Index 2 - green matching function, Index 3 - blue matching function
-    cie_matrix = np.genfromtxt("matching_functions/cie-cmf.txt")
+    cie_matrix = load_table("cie-cmf.txt").copy()
 
     #Import tab-delimited file of wavelength axis
     mtrdr_axis = modify_mtrdr_axis()
@@ -222,6 +805,7 @@ def mtrdr_color_matching(wave_list):
     
     #Concatenate the results
     new_mat = np.stack([red, green, blue], axis=-1)
+    new_mat.flags.writeable = False
     return(new_mat)
 
 
@@ -290,8 +874,81 @@ def format_mtrdr(cube):
     
     return(cube)
 
-def color_from_cube(cube, cs, mode="raw"):
-    """Core functionality for calculating human perceptual color from CRISM MTRDR."""
+def read_filled_window(src, bands, window=None, out_shape=None):
+    """Reads the first bands of a window of an open MTRDR image, decimated to out_shape (rows,
+    cols) if given, and fills it with format_mtrdr(). Returns it with a mask of valid pixels."""
+    if out_shape is not None:
+        out_shape = (bands,) + tuple(out_shape)
+    img = src.read(indexes=list(range(1, bands + 1)), window=window, out_shape=out_shape)
+    valid = (img[0] >= 0) & (img[0] < 1)
+    #Null values = 0, as in mtrdr_to_color()
+    img[img < 0] = 0
+    img[img >= 1] = 0
+    return format_mtrdr(img), valid
+
+def whiteflat_path(file=None):
+    """Returns the whiteflat calibration spectrum to use: file if given, otherwise
+    mtrdr_whiteflat.csv in the current directory or else next to crism.py."""
+    if file is not None:
+        return file
+    if os.path.exists("mtrdr_whiteflat.csv"):
+        return "mtrdr_whiteflat.csv"
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), "mtrdr_whiteflat.csv")
+
+def mtrdr_whiteflat(cube_bands, file=None):
+    """Returns the per-band correction factors of the improved CRISM VNIR calibration,
+    read-only. The factors are cached until the spectrum file changes."""
+    path = whiteflat_path(file)
+    return _whiteflat_factors(cube_bands, os.path.abspath(path), os.path.getmtime(path))
+
+@functools.lru_cache(maxsize=32)
+def _whiteflat_factors(cube_bands, path, mtime):
+    # CRISM VNIR 362nm - 1053nm calibration correction,
+    # quantized into crism.py internal convention of starting at 380nm in 5 nm intervals.
+    # Based on white surface spectrum saved saved with http://crism.jhuapl.edu/JCAT
+    # for example from north polar snow surfaces in frt000128f3_07_if165j_mtr3.img.
+    w = 380
+    dw = 5
+    whiteflatraw = np.genfromtxt(path, delimiter=",")
+    whiteflatraw = whiteflatraw[:, [1,2]]
+    whiteflatraw_bands = whiteflatraw[:, 0]
+    whiteflat = np.zeros(cube_bands, dtype=float)
+    whiteflatraw_max = 0
+    for i in range(0, cube_bands):
+        whiteflat[i] = whiteflatraw[find_band(whiteflatraw_bands, w)][1]
+        whiteflatraw_max = max(whiteflat[i], whiteflatraw_max)
+        w = w + dw
+    whiteflat = whiteflatraw_max / whiteflat
+    whiteflat.flags.writeable = False
+    return(whiteflat)
+
+def whiteflat_correct(cube):
+    """Returns the cube (bands first) scaled by the whiteflat factors of mtrdr_whiteflat(),
+    in the data type of the cube."""
+    #Band by band, each band scaled in double precision and stored back in the cube's type
+    whiteflat = mtrdr_whiteflat(cube.shape[0])
+    corrected = np.empty_like(cube)
+    for i in range(cube.shape[0]):
+        corrected[i] = whiteflat[i] * cube[i]
+    return corrected
+
+def color_from_cube(cube, cs, mode="raw", stretch=None, corrected=False):
+    """Core functionality for calculating human perceptual color from CRISM MTRDR.
+
+    The luminance offsets and contrast stretches are taken from the stretch dictionary;
+    missing entries are computed from this cube and stored in it. Rendering a decimated
+    copy of a scene with an empty dictionary thus gives statistics which can then be
+    reused to render any part of the scene with the same colors. Stretches with a
+    "percentile" entry, see color_statistics(), map their limits onto 0 and 1. Pass
+    corrected=True if the cube has already been through whiteflat_correct()."""
+    if stretch is None:
+        stretch = {}
+
+    # CRISM VNIR 362nm - 1053nm calibration correction, see mtrdr_whiteflat().
+    # Scaling into a new array leaves the caller's cube untouched.
+    if not corrected:
+        cube = whiteflat_correct(cube)
+
     #Transpose array to put the wavelength axis last - personal preference
     cube = cube.transpose(1,2,0)
     
@@ -310,52 +967,54 @@ def color_from_cube(cube, cs, mode="raw"):
     #weights = cs.cmf.copy()
     weights = np.ones([61,3])
 
-    # CRISM VNIR 362nm - 1053nm calibration correction,
-    # quantized into crism.py internal convention of starting at 380nm in 5 nm intervals.
-    # Based on white surface spectrum saved saved with http://crism.jhuapl.edu/JCAT
-    # for example from north polar snow surfaces in frt000128f3_07_if165j_mtr3.img.
-    w = 380
-    dw = 5
-    whiteflatraw = np.genfromtxt("mtrdr_whiteflat.csv", delimiter=",")
-    whiteflatraw = whiteflatraw[:, [1,2]]
-    whiteflatraw_bands = whiteflatraw[:, 0]
-    cube_bands = cube.shape[2]
-    whiteflat = np.zeros(cube_bands, dtype=float)
-    whiteflatraw_max = 0
-    for i in range(0, cube_bands):
-        whiteflat[i] = whiteflatraw[find_band(whiteflatraw_bands, w)][1]
-        whiteflatraw_max = max(whiteflat[i], whiteflatraw_max)
-        w = w + dw
-    whiteflat = whiteflatraw_max / whiteflat
-    for i in range(0, cube_bands):
-        cube[:,:,i] = whiteflat[i] * cube[:,:,i]
+    blu_lumin = calculate_luminance(weights[:,0], cube, 0)
+    grn_lumin = calculate_luminance(weights[:,1], cube, 0)
+    red_lumin = calculate_luminance(weights[:,2], cube, 0)
 
-    blu_lumin = calculate_luminance(weights[:,0], cube)
-    grn_lumin = calculate_luminance(weights[:,1], cube)
-    red_lumin = calculate_luminance(weights[:,2], cube)
+    #Without given offsets, take them from this cube as calculate_luminance() does
+    if "offset" not in stretch:
+        stretch["offset"] = []
+        for channel, channel_lumin in enumerate((blu_lumin, grn_lumin, red_lumin)):
+            short, long = filter_band_range(weights[:,channel])
+            stretch["offset"].append(np.mean(cube[:,:,short:long]) - np.mean(channel_lumin))
+    blu_lumin = blu_lumin + stretch["offset"][0]
+    grn_lumin = grn_lumin + stretch["offset"][1]
+    red_lumin = red_lumin + stretch["offset"][2]
     
     #Merge luminance cubes together, then perform a contrast stretch. Adding 2% buffers to the minimum
     #and maximum values to avoid histogram clipping.
     lumin = np.stack((blu_lumin, grn_lumin, red_lumin), axis=0)
-    lumin = (lumin - (np.amin(lumin) - (0.02*np.amin(lumin)))) / ((np.amax(lumin) + (0.02*np.amax(lumin))))
+    if "lumin" not in stretch:
+        stretch["lumin"] = (np.amin(lumin), np.amax(lumin))
+    lumin_min, lumin_max = stretch["lumin"]
+    if stretch.get("percentile") is None:
+        lumin = (lumin - (lumin_min - (0.02*lumin_min))) / ((lumin_max + (0.02*lumin_max)))
+    else:
+        #Percentile limits from color_statistics() are mapped onto 0 and 1, the brightest and
+        #darkest pixels beyond them saturate
+        lumin = (lumin - lumin_min) / (lumin_max - lumin_min)
 
-    #Now reshape the data array so that it's one dimensional and runs more quickly in the loop that
-    #calculates chromaticity values (I'm not sure if the chromaticity calculation can be set up to take
-    #advantge of broadcasting ufuncs. 
+    #Now reshape the data array so that it's one spectrum per row for the chromaticity calculation.
     rows = cube.shape[0]
     cols = cube.shape[1]
     pixels = rows*cols
     cube = cube.reshape(pixels, cube.shape[2])
 
-    #Create a new cube to handle the interpolated color data
-    clone_cube = np.empty((cube.shape[0], 3))
-
-    #Convert the wavelength range to RGB values. If this can be broadcast this would
-    #run much more quickly.
-    # todo: this operation can be done must faster with numpy and broadcasting ufuncs
-    for pixel in range(0, pixels):
-        clone_cube[pixel] = cs.spec_to_rgb(cube[pixel])
+    #Convert the wavelength range to RGB values, all pixels at once.
+    clone_cube = cs.spectra_to_rgb(cube)
         
+    return shade_color(clone_cube, lumin, mode, stretch)
+
+def shade_color(rgb, lumin, mode="raw", stretch=None):
+    """Stretches chromaticity rgb values of shape (pixels, 3) as given by mode and the "rgb" entry
+    of the stretch dictionary, multiplies them with the stretched luminance images of shape
+    (3, rows, cols) and returns the result as a uint16 color image."""
+    if stretch is None:
+        stretch = {}
+    rows = lumin.shape[1]
+    cols = lumin.shape[2]
+    clone_cube = rgb
+
     #When chromaticity values integrate outside of the [0-1] range, they need to be scaled back to 
     #that range to be displayed within the chosen colorspace. The ColourSystem class as written by
     #"Christian" normalized on a per-pixel basis, which destroys relative color information. This was
@@ -368,12 +1027,21 @@ def color_from_cube(cube, cs, mode="raw"):
     #"WB" independently normalizes each color channel, similar to the output provided in the official
     #CRISM parameter products. 
 
+    #The quicknorm() minimum and maximum are kept per channel in the stretch.
     if mode=="raw":
-        clone_cube = quicknorm(clone_cube)
+        if "rgb" not in stretch:
+            stretch["rgb"] = (np.full(3, np.amin(clone_cube)), np.full(3, np.amax(clone_cube)))
 
     if mode=="wb":
-        for channel in range(0, clone_cube.shape[1]):
-            clone_cube[:,channel] = quicknorm(clone_cube[:,channel])
+        if "rgb" not in stretch:
+            stretch["rgb"] = (np.amin(clone_cube, axis=0), np.amax(clone_cube, axis=0))
+
+    if mode=="raw" or mode=="wb":
+        rgb_min, rgb_max = stretch["rgb"]
+        if stretch.get("percentile") is None:
+            clone_cube = (clone_cube - rgb_min) / rgb_max
+        else:
+            clone_cube = (clone_cube - rgb_min) / (rgb_max - rgb_min)
         
     #Reshape pixels back to original x,y orientation
     cube = clone_cube.reshape(rows, cols, 3).transpose(2, 0, 1)
@@ -383,561 +1051,1809 @@ def color_from_cube(cube, cs, mode="raw"):
     cube[1,:,:] = cube[1,:,:] * lumin[1]
     cube[2,:,:] = cube[2,:,:] * lumin[2]
     
-    #Convert to unsigned 16-bit
-    cube = convert_uint16(cube)
+    #Convert to unsigned 16-bit. Statistics taken from another part of the scene may not cover
+    #every value of this cube, so clip instead of letting the integer conversion wrap around.
+    cube = convert_uint16(np.clip(cube, 0, 1))
     
     return(cube)
 
-def mtrdr_to_color(file, name, standard_params=True, new_params=None):
-    """Function to produce perceptually-accurate color from CRISM MTRDR data."""
-
-    with rasterio.open(file) as src:
-        profile = src.profile
-        img = src.read()
-    cs = cs_srgb
+def color_statistics(cubes, cs, mode="raw", percentile=None, sample=1, seed=0):
+    """Returns the stretch dictionary for color_from_cube() of a whole scene, gathered in one
+    pass of StreamStatistics over an iterable of whiteflat corrected parts of the scene (bands
+    first), e.g. row blocks, so that only one part has to be in memory at a time. Each part
+    comes with the mask of its valid pixels, as returned by read_filled_window().
 
-    #Make null values = 0 so that it doesn't break when doing rgb conversion
-    #Also need to convert the null pixels outside of image to 0.
-    img[img < 0] = 0
-    img[img >= 1] = 0
-
-    img = format_mtrdr(img)
-
-    profile.update(
-        dtype = rasterio.uint16,
-        count = 3,
-        driver = 'PNG'
-    )
-    
-    if standard_params == True:
-        process_list = ["VIS"]
-        mode_list = ["raw"]
+    By default the stretch is the one color_from_cube() computes itself. With percentile, the
+    luminance and chromaticity are stretched between their percentile-th and (100 - percentile)-th
+    percentiles of the valid pixels instead, so that a few hot pixels don't darken the image.
+    With sample below 1, their statistics are taken from that random fraction of the pixels."""
+    weights = np.ones([61,3])
+    rng = np.random.default_rng(seed)
+    band_sums = 0
+    pixels = 0
+    bins = 0 if percentile is None else STATISTICS_BINS
+    lumin = [StreamStatistics(bins) for channel in range(3)]
+    rgb = [StreamStatistics(bins) for channel in range(3)]
+
+    for cube, valid in cubes:
+        cube = cube.transpose(1,2,0)
+        band_sums = band_sums + np.sum(cube, axis=(0,1))
+        pixels += cube.shape[0] * cube.shape[1]
+
+        #The luminance offsets need the band means of the whole scene, so gather the luminance
+        #without offset here and add the offsets at the end. Like color_from_cube(), the minimum
+        #and maximum count the null pixels filled with 0, percentiles are of the valid pixels.
+        spectra = cube[valid] if percentile is not None else cube
+        spectra = sample_pixels(spectra, sample, rng)
+        for channel in range(3):
+            lumin[channel].add(calculate_luminance(weights[:,channel], spectra[np.newaxis], 0))
+
+        chromaticity = cs.spectra_to_rgb(spectra)
+        for channel in range(3):
+            rgb[channel].add(chromaticity[:, channel])
+
+    offset = [luminance_offset(weights[:,channel], band_sums / pixels) for channel in range(3)]
+    lumin_range = [np.add(lumin[channel].stretch_range(percentile), offset[channel]) for channel in range(3)]
+    stretch = {"offset": offset, "lumin": (min(low for low, high in lumin_range), max(high for low, high in lumin_range)),
+               "percentile": percentile}
+    if mode=="raw":
+        combined = StreamStatistics(bins)
+        for channel in range(3):
+            combined.merge(rgb[channel])
+        low, high = combined.stretch_range(percentile)
+        stretch["rgb"] = (np.full(3, low), np.full(3, high))
+    if mode=="wb":
+        ranges = [rgb[channel].stretch_range(percentile) for channel in range(3)]
+        stretch["rgb"] = (np.array([low for low, high in ranges]), np.array([high for low, high in ranges]))
+    return stretch
+
+#MTRDR scenes
+
+class LRUCache:
+    """Thread-safe LRU cache holding at most max_bytes, measuring each value with sizeof."""
+
+    def __init__(self, max_bytes, sizeof=len):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.items = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.get(key)
+            if value is not None:
+                self.items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """Store a value, evicting the least recently used ones. Values larger than the cache
+        are not stored, rather than flushing everything else."""
+        size = self.sizeof(value)
+        with self.lock:
+            if key in self.items:
+                self.size -= self.sizeof(self.items.pop(key))
+            if size > self.max_bytes:
+                return
+            self.items[key] = value
+            self.size += size
+            while self.size > self.max_bytes and self.items:
+                self.size -= self.sizeof(self.items.popitem(last=False)[1])
+
+    def discard(self, match):
+        """Remove all entries whose key satisfies match(key)."""
+        with self.lock:
+            for key in [key for key in self.items if match(key)]:
+                self.size -= self.sizeof(self.items.pop(key))
+
+def _stage_size(value):
+    """Returns the memory held by a cached scene stage: arrays and their masks count, the
+    profile and stretch statistics are small enough to be left out."""
+    if isinstance(value, np.ndarray):
+        mask = np.ma.getmask(value)
+        return value.nbytes + (mask.nbytes if mask is not np.ma.nomask else 0)
+    return 0
+
+#Memory budget in megabytes for the pipeline stages of all MtrdrScene objects of the process
+SCENE_CACHE_MB = 2048
+
+def _holding_stages(method):
+    #Product methods hold their stages for the duration of the call, see MtrdrScene
+    @functools.wraps(method)
+    def product(self, *args, **kwargs):
+        with self:
+            return method(self, *args, **kwargs)
+    return product
+
+class MtrdrScene:
+    """An MTRDR image with memoized pipeline stages, offering every mtrdr_to_* product as a
+    method, so that rendering several products of one scene reads and prepares it only once.
+
+    The raw cube, the gap-filled cube (clamped to [0, 1) for color, unclamped for the filter
+    products), the whiteflat-corrected cube of a wavelength range, the filter images and the
+    color stretch statistics are computed on first use and kept read-only in the process-wide
+    LRU cache MtrdrScene.cache. It evicts the least recently used stages of all scenes beyond
+    SCENE_CACHE_MB megabytes and doesn't keep stages larger than that. Stages are keyed by
+    the file and its modification time, so new scene objects of the same file, as created by
+    the mtrdr_to_* functions, share them.
+
+    Within a "with scene:" block, and thus during every product method, the scene object also
+    holds on to the stages it uses. Stages larger than the cache are then computed only once
+    per product, not again by each stage depending on them."""
+
+    cache = LRUCache(SCENE_CACHE_MB * 1024 * 1024, sizeof=_stage_size)
+
+    def __init__(self, file):
+        self.file = file
+        try:
+            mtime = os.path.getmtime(file)
+        except OSError:
+            mtime = None
+        self.key = (os.path.abspath(file), mtime)
+        self.held = None
+        self.holding = 0
+
+    def __enter__(self):
+        if self.holding == 0:
+            self.held = {}
+        self.holding += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.holding -= 1
+        if self.holding == 0:
+            self.held = None
+
+    def stage(self, name, compute):
+        """Returns the stage cached under the name tuple, computing it with compute() on a miss."""
+        held = self.held
+        if held is not None and name in held:
+            return held[name]
+        key = self.key + name
+        value = self.cache.get(key)
+        if value is None:
+            value = compute()
+            if isinstance(value, np.ndarray):
+                value.flags.writeable = False
+            self.cache.put(key, value)
+        if held is not None:
+            held[name] = value
+        return value
+
+    def forget(self):
+        """Drop all cached stages of the scene."""
+        self.cache.discard(lambda key: key[0:2] == self.key)
+
+    def profile(self):
+        """Returns a copy of the raster profile of the scene."""
+        def compute():
+            import rasterio
+            with rasterio.open(self.file) as src:
+                return src.profile
+        return dict(self.stage(("profile",), compute))
+
+    def raw(self, wave_range=None):
+        """Returns the leading bands of the cube as read from the file, those needed for any
+        of the built-in products or for wave_range, see mtrdr_product_bands()."""
+        bands = mtrdr_product_bands(wave_range)
+        def compute():
+            profile, cube = read_mtrdr(self.file, bands)
+            self.cache.put(self.key + ("profile",), profile)
+            return cube
+        return self.stage(("raw", bands), compute)
+
+    def filled(self, clamp=False, wave_range=None):
+        """Returns the cube of raw(wave_range) gap-filled with format_mtrdr(). With clamp, null
+        values and the null pixels outside of the image are set to 0 first, as needed for the
+        rgb conversion."""
+        def compute():
+            #Fill block by block into the result, so that neither a clamped copy of the raw
+            #cube nor the intermediate arrays of format_mtrdr() exist in full
+            img = self.raw(wave_range)
+            filled = None
+            #Blocks of about 32 MB of raw data
+            block_rows = max(1, (32 << 20) // max(1, img[:, :1].nbytes))
+            for row in range(0, img.shape[1], block_rows):
+                block = img[:, row:row + block_rows]
+                if clamp:
+                    block = block.copy()
+                    block[block < 0] = 0
+                    block[block >= 1] = 0
+                block = format_mtrdr(block)
+                if filled is None:
+                    filled = np.empty((block.shape[0],) + img.shape[1:], dtype=block.dtype)
+                filled[:, row:row + block_rows] = block
+            return filled
+        return self.stage(("filled", clamp, mtrdr_product_bands(wave_range)), compute)
+
+    def _whiteflat_key(self):
+        path = os.path.abspath(whiteflat_path())
+        return (path, os.path.getmtime(path))
+
+    def corrected(self, wave_range):
+        """Returns the clamped, gap-filled cube cropped to wave_range and whiteflat corrected."""
+        def compute():
+            return whiteflat_correct(mtrdr_crop_bands(self.filled(clamp=True, wave_range=wave_range), wave_range))
+        return self.stage(("corrected", tuple(wave_range)) + self._whiteflat_key(), compute)
+
+    def filter_cube(self, wave_range):
+        """Returns the unclamped, gap-filled cube cropped to wave_range as a masked array with
+        the wavelength axis last, the input of the filter products."""
+        def compute():
+            cube = mtrdr_crop_bands(self.filled(wave_range=wave_range), wave_range)
+            return np.ma.masked_values(cube.transpose(1,2,0), 65535)
+        return self.stage(("filters", tuple(wave_range)), compute)
+
+    def filter_image(self, wave_range, weights):
+        """Returns the image through a filter with the transmission weights, integrated over
+        filter_cube(wave_range) with calculate_luminance()."""
+        def compute():
+            return calculate_luminance(weights, self.filter_cube(wave_range))
+        return self.stage(("filter", tuple(wave_range), np.asarray(weights).tobytes()), compute)
+
+    def valid(self):
+        """Returns the mask of the pixels with valid values, as read_filled_window() does."""
+        def compute():
+            img = self.raw()
+            return (img[0] >= 0) & (img[0] < 1)
+        return self.stage(("valid",), compute)
+
+    def _stretch_key(self, wave_range, mode, percentile, sample, streamed=False):
+        #Streamed statistics take their offsets from band means, so they are kept apart from
+        #the ones of color_image(), which would otherwise depend on earlier streamed renders
+        key = self.key + ("stretch", tuple(wave_range), mode, percentile, sample) + self._whiteflat_key()
+        return key + ("streamed",) if streamed else key
+
+    def color_image(self, wave_range, mode="raw", percentile=None, sample=1):
+        """Returns the uint16 perceptual color image of wave_range, see color_from_cube(). The
+        stretch statistics are computed by the first render and reused afterwards, with
+        color_statistics() for percentile stretches or subsampled statistics."""
+        key = self._stretch_key(wave_range, mode, percentile, sample)
+        stretch = self.cache.get(key)
+        computed = stretch is None
+        cs = colour_system("srgb").with_colour_matching(mtrdr_color_matching(wave_range))
+        cube = self.corrected(wave_range)
+        if computed:
+            stretch = {}
+            if percentile is not None or sample < 1:
+                valid = self.valid()
+                blocks = ((cube[:, row:row + BLOCK_ROWS], valid[row:row + BLOCK_ROWS]) for row in range(0, cube.shape[1], BLOCK_ROWS))
+                stretch = color_statistics(blocks, cs, mode, percentile, sample)
+        cube = color_from_cube(cube, cs, mode=mode, stretch=stretch, corrected=True)
+        if computed:
+            self.cache.put(key, stretch)
+        return cube
+
+    def corrected_blocks(self, wave_range, block_rows=BLOCK_ROWS):
+        """Yields corrected(wave_range) in blocks of block_rows rows with the mask of their valid
+        pixels, each read from the file with a windowed read of the bands needed, so that the
+        full cube is never loaded."""
+        import rasterio
+        bands = mtrdr_source_bands(wave_range)
+        with rasterio.open(self.file) as src:
+            for row in range(0, src.height, block_rows):
+                job = _current_job()
+                if job is not None:
+                    job.checkpoint()
+                window = rasterio.windows.Window(0, row, src.width, min(block_rows, src.height - row))
+                img, valid = read_filled_window(src, bands, window)
+                yield whiteflat_correct(mtrdr_crop_bands(img, wave_range)), valid
+
+    def color_stretch(self, wave_range, mode="raw", percentile=None, sample=1, block_rows=BLOCK_ROWS):
+        """Returns the color stretch statistics of wave_range for color_rows(). The first call
+        gathers them from corrected_blocks() with color_statistics(), later ones reuse them."""
+        key = self._stretch_key(wave_range, mode, percentile, sample, streamed=True)
+        stretch = self.cache.get(key)
+        if stretch is None:
+            cs = colour_system("srgb").with_colour_matching(mtrdr_color_matching(wave_range))
+            stretch = color_statistics(self.corrected_blocks(wave_range, block_rows), cs, mode, percentile, sample)
+            self.cache.put(key, stretch)
+        return stretch
+
+    def color_rows(self, wave_range, mode="raw", percentile=None, sample=1, block_rows=BLOCK_ROWS):
+        """Yields the color image of color_image() as uint16 row blocks for write_raster(),
+        rendered from corrected_blocks() with color_stretch(). Neither the cube nor the image
+        is ever held in memory in full, so scenes larger than memory can be rendered."""
+        stretch = self.color_stretch(wave_range, mode, percentile, sample, block_rows)
+        cs = colour_system("srgb").with_colour_matching(mtrdr_color_matching(wave_range))
+        for cube, valid in self.corrected_blocks(wave_range, block_rows):
+            yield color_from_cube(cube, cs, mode=mode, stretch=stretch, corrected=True)
+
+    @_holding_stages
+    def to_color(self, name, standard_params=True, new_params=None, queue_depth=4, fmt="png", stream=False,
+                 percentile=None, sample=1):
+        """Function to produce perceptually-accurate color from CRISM MTRDR data. With stream,
+        the images are rendered and written block by block with color_rows()."""
+
+        def render(wave_range, mode):
+            if not stream:
+                return self.color_image(wave_range, mode, percentile, sample)
+            #Gather the statistics here, so that the writer thread only renders the blocks
+            self.color_stretch(wave_range, mode, percentile, sample)
+            return self.color_rows(wave_range, mode, percentile, sample)
+
+        ext = output_extension(fmt)
+        profile = self.profile()
+
+        profile.update(
+            dtype = 'uint16',
+            count = 3,
+            **output_options(fmt)
+        )
+        with AsyncWriter(queue_depth) as writer:
         
-        for param, mode in zip(process_list, mode_list):
+            if standard_params == True:
+                process_list = ["VIS"]
+                mode_list = ["raw"]
+            
+                for param, mode in zip(process_list, mode_list):
 
-            if param == "VIS":
-                #Imitate VIS browse product summarizing wavelength range from 380 to 780 nm
-                wave_range = [380, 780]
+                    if param == "VIS":
+                        #Imitate VIS browse product summarizing wavelength range from 380 to 780 nm
+                        wave_range = [380, 780]
 
-            if param == "FAL":
-                #Imitate FAL browse product summarizing wavelength range from 1.01 to 2.60 microns
-                wave_range = [1010, 2600]
+                    if param == "FAL":
+                        #Imitate FAL browse product summarizing wavelength range from 1.01 to 2.60 microns
+                        wave_range = [1010, 2600]
 
-            if param == "FEM":
-                #Integrate over 750 nm to 1200nm to capture variability in Fe oxidation state/mineralogy
-                wave_range = [750, 1200]
+                    if param == "FEM":
+                        #Integrate over 750 nm to 1200nm to capture variability in Fe oxidation state/mineralogy
+                        wave_range = [750, 1200]
 
-            if param == "MAF":
-                #Integrate over 800 nm to 2 micron wavelength range capturing variability in
-                #primary basaltic minerals.
-                wave_range = [800, 2000]
+                    if param == "MAF":
+                        #Integrate over 800 nm to 2 micron wavelength range capturing variability in
+                        #primary basaltic minerals.
+                        wave_range = [800, 2000]
 
-            if param == "PHY":
-                #Integrate over 1.8 to 2.3 micron wavelength range capturing variability in 
-                #clay mineralogy.
-                wave_range = [1800, 2300]
+                    if param == "PHY":
+                        #Integrate over 1.8 to 2.3 micron wavelength range capturing variability in 
+                        #clay mineralogy.
+                        wave_range = [1800, 2300]
 
-            if param == "FAR":
-                #Integrate over the longwave detector (2.8 microns to 3.6 microns)
-                wave_range = [2800, 3900]
+                    if param == "FAR":
+                        #Integrate over the longwave detector (2.8 microns to 3.6 microns)
+                        wave_range = [2800, 3900]
 
-            if param == "CAR":
-                #Integrate from 2.8 microns to 3.4 microns capturing region of water and carbonate
-                wave_range = [2900, 3400]
+                    if param == "CAR":
+                        #Integrate from 2.8 microns to 3.4 microns capturing region of water and carbonate
+                        wave_range = [2900, 3400]
 
+                
+                    cube = render(wave_range, mode)
+                    #Export image file
+                    writer.submit(name+"_"+param+ext, profile, cube)
+                
+            if new_params != None:
             
-            cube = mtrdr_crop_bands(img, wave_range)
-            ColourSystem.cmf = mtrdr_color_matching(wave_range)
-            cube = color_from_cube(cube, cs, mode=mode)
-            #Export PNG file
-            with rasterio.open(name+"_"+param+".png", 'w', **profile) as out:
-                out.write(cube)
-            
-    if new_params != None:
-        
-        for item in new_params:
-            
-            if len(item) != 2:
-                print("Error: Wavelength list appears to be incorrectly formatted.")
-                print("New parameters should be in form [[wave1, wave2], [wave1, wave2], ...]")
+                for item in new_params:
                 
-            else:
-                cube = mtrdr_crop_bands(img, item)
-                ColourSystem.cmf = mtrdr_color_matching(item)
-                cube = color_from_cube(cube, cs, mode=mode)
-                with rasterio.open(name+"_"+str(item[0])+"_"+str(item[1])+".png", 'w', **profile) as out:
-                    out.write(cube)
-    
-    pass
-
+                    if len(item) != 2:
+                        print("Error: Wavelength list appears to be incorrectly formatted.")
+                        print("New parameters should be in form [[wave1, wave2], [wave1, wave2], ...]")
+                    
+                    else:
+                        cube = render(item, mode)
+                        writer.submit(name+"_"+str(item[0])+"_"+str(item[1])+ext, profile, cube)
+        
 
+    @_holding_stages
+    def to_cassis(self, fname, color="IPB", fmt="png", percentile=None, sample=1):
+        
+        ##Data I/O and formatting
+        ext = output_extension(fmt)
+        profile = self.profile()
+        wave_range = [380, 1100]
+        
+        #Developer note: CaSSIS filter responses are stored in the following order:
+        #[0] - MTRDR wavelength; [1] - Blue; [2] - PAN; [3] - Red; [4] - NIR
+        
+        #Filter information retrieved from the Spanish Virtual Observatory Filter Profile Repository
+        filter_response = load_table("cassis-response-mtrdr.txt", delimiter="\t")
+        
+        ##Calculate filter images filters via integration
+        
+        blu = self.filter_image(wave_range, filter_response[:, 1])
+        pan = self.filter_image(wave_range, filter_response[:, 2])
+        red = self.filter_image(wave_range, filter_response[:, 3])
+        nir = self.filter_image(wave_range, filter_response[:, 4])
+        
 
-def mtrdr_to_cassis(file, fname, color="IPB"):
-    
-    ##Data I/O and formatting
-    with rasterio.open(file) as src:
-        profile = src.profile
-        cube = src.read()
-    
-    cube = format_mtrdr(cube)
-    cube = mtrdr_crop_bands(cube, [380, 1100])
-    cube = cube.transpose(1,2,0)
-    cube = np.ma.masked_values(cube, 65535)
-    
-    #Developer note: CaSSIS filter responses are stored in the following order:
-    #[0] - MTRDR wavelength; [1] - Blue; [2] - PAN; [3] - Red; [4] - NIR
-    
-    #Filter information retrieved from the Spanish Virtual Observatory Filter Profile Repository
-    filter_response = np.genfromtxt("matching_functions/cassis-response-mtrdr.txt", delimiter="\t")
-    
-    ##Calculate filter images filters via integration
-    
-    blu = calculate_luminance((filter_response[:, 1]), cube)
-    pan = calculate_luminance((filter_response[:, 2]), cube)
-    red = calculate_luminance((filter_response[:, 3]), cube)
-    nir = calculate_luminance((filter_response[:, 4]), cube)
-    
+        if color == "IPB":
+            export = (nir, pan, blu)
+            
+        elif color == "IRB":
+            export = (red, pan, blu)
+            
+        elif color == "ENH":
+            enh_red = red/pan
+            enh_grn = pan/blu
+            enh_blu = pan/nir
+            
+            enh_red += np.average(enh_grn) - np.average(enh_red)
+            enh_blu += np.average(enh_grn) - np.average(enh_blu)
+            export = (enh_red, enh_grn, enh_blu)
+            
+        else:
+            print("Invalid color keyword, use 'IPB', 'IRB', or 'ENH'.")
+        
+        export = stretch_rows(export, export_stretch(export, percentile, sample), percentile)
+        
+        #Update profile for color export
+        profile.update(
+            dtype = 'uint16',
+            count = 3,
+            **output_options(fmt)
+        )
+        
+        write_raster(fname+"_"+color+ext, profile, export)
+                    
+        return
 
-    if color == "IPB":
-        export = np.stack((nir, pan, blu))
+    @_holding_stages
+    def to_hirise(self, fname, color="IRB", fmt="png", percentile=None, sample=1):
         
-    elif color == "IRB":
-        export = np.stack((red, pan, blu))
+        ##Data I/O and formatting
+        ext = output_extension(fmt)
+        profile = self.profile()
+        wave_range = [380, 1100]
         
-    elif color == "ENH":
-        enh_red = red/pan
-        enh_grn = pan/blu
-        enh_blu = pan/nir
+        #Developer note: HiRISE filter responses are stored in the following order:
+        #[0] - MTRDR wavelength; [1] - NIR; [2] - Red; [3] - Blue-Green
         
-        enh_red += np.average(enh_grn) - np.average(enh_red)
-        enh_blu += np.average(enh_grn) - np.average(enh_blu)
-        export = np.stack((enh_red, enh_grn, enh_blu))
+        #Filter information retrieved from the Spanish Virtual Observatory Filter Profile Repository
+        filter_response = load_table("hirise-response-mtrdr.txt", delimiter="\t")
         
-    else:
-        print("Invalid color keyword, use 'IPB', 'IRB', or 'ENH'.")
-    
-    export = (export - (np.amin(export) - (0.02*np.amin(export)))) / ((np.amax(export) + (0.02*np.amax(export))))    
-    export = convert_uint16(export)
-    
-    #Update profile for color export
-    profile.update(
-        dtype = rasterio.uint16,
-        count = 3,
-        driver = 'PNG'
-    )
-    
-    with rasterio.open(fname+"_"+color+".png", 'w', **profile) as out:
-                out.write(export)
-                
-    return
+        ##Calculate filter images filters via integration
+        
+        nir = self.filter_image(wave_range, filter_response[:, 1])
+        red = self.filter_image(wave_range, filter_response[:, 2])
+        bgr = self.filter_image(wave_range, filter_response[:, 3])
 
+        if color == "IRB":
+            export = (nir, red, bgr)
+            
+        elif color == "RGB":
+            #If RGB is requested, calculate synthetic blue filter according to HiRISE team formula
+            blu = (bgr * 2) - (red * 0.3)
+            #The blue channel tends to be bright, so applying an offset to simulate the I/F of blue
+            #light in CRISM.
+            blu += np.average(self.filter_cube(wave_range)[:,:,0:10]) - np.average(blu)
+            export = (red, bgr, blu)
+            
+        elif color == "ENH":
+            enh_red = nir/red
+            enh_grn = nir/bgr
+            enh_blu = red/bgr
+            
+            enh_red += np.average(enh_grn) - np.average(enh_red)
+            enh_blu += np.average(enh_grn) - np.average(enh_blu)
+            export = (enh_red, enh_grn, enh_blu)
+            
+        else:
+            print("Invalid color keyword, use 'IRB' or 'RGB'.")
+        
+        export = stretch_rows(export, export_stretch(export, percentile, sample), percentile)
+        
+        #Update profile for color export
+        profile.update(
+            dtype = 'uint16',
+            count = 3,
+            **output_options(fmt)
+        )
+        
+        write_raster(fname+"_"+color+ext, profile, export)
+                    
+        return
 
-def mtrdr_to_hirise(file, fname, color="IRB"):
-    
-    ##Data I/O and formatting
-    with rasterio.open(file) as src:
-        profile = src.profile
-        cube = src.read()
-    
-    cube = format_mtrdr(cube)
-    cube = mtrdr_crop_bands(cube, [380, 1100])
-    cube = cube.transpose(1,2,0)
-    cube = np.ma.masked_values(cube, 65535)
-    
-    #Developer note: HiRISE filter responses are stored in the following order:
-    #[0] - MTRDR wavelength; [1] - NIR; [2] - Red; [3] - Blue-Green
-    
-    #Filter information retrieved from the Spanish Virtual Observatory Filter Profile Repository
-    filter_response = np.genfromtxt("matching_functions/hirise-response-mtrdr.txt", delimiter="\t")
-    
-    ##Calculate filter images filters via integration
-    
-    nir = calculate_luminance((filter_response[:, 1]), cube)
-    red = calculate_luminance((filter_response[:, 2]), cube)
-    bgr = calculate_luminance((filter_response[:, 3]), cube)
+    @_holding_stages
+    def to_hrsc(self, fname, color="IGB", lumin=False, queue_depth=4, fmt="png", percentile=None, sample=1):
+        
+        ##Data I/O and formatting
+        ext = output_extension(fmt)
+        profile = self.profile()
+        wave_range = [380, 1100]
+        
+        #Developer note: HRSC filter responses are stored in the following order:
+        #[0] - MTRDR wavelength; [1] - Nadir; [2] - NIR; [3] - Red; [4] - Green; [5] - Blue;
+        #[6] - Photometry; [7] - Stereo
+        
+        #Approximately 15% of the light entering the HRSC blue filter in the N-UV is not visible
+        #to CRISM, so the filter response is a little different from reality.
+        
+        #Filter information retrieved from the Spanish Virtual Observatory Filter Profile Repository
+        filter_response = load_table("hrsc-response-mtrdr.txt", delimiter="\t")
+        
+        ##Calculate filter images filters via integration
+        
+        nad = self.filter_image(wave_range, filter_response[:, 1])
+        nir = self.filter_image(wave_range, filter_response[:, 2])
+        red = self.filter_image(wave_range, filter_response[:, 3])
+        grn = self.filter_image(wave_range, filter_response[:, 4])
+        blu = self.filter_image(wave_range, filter_response[:, 5])
+        pho = self.filter_image(wave_range, filter_response[:, 6])
+        ste = self.filter_image(wave_range, filter_response[:, 7])
+        
+        if color == "IGB":
+            export = (nir, grn, blu)
+            
+        elif color == "IRB":
+            export = (nir, red, blu)
+            
+        elif color == "RGB":
+            export = (red, grn, blu)
+            
+        else:
+            print("Invalid color keyword, use 'IGB', 'IRB', or 'RGB'.")
+        
+        export = stretch_rows(export, export_stretch(export, percentile, sample), percentile)
+        
+        #Update profile for color export
+        profile.update(
+            dtype = 'uint16',
+            count = 3,
+            **output_options(fmt)
+        )
+        
+        with AsyncWriter(queue_depth) as writer:
+            writer.submit(fname+"_"+color+ext, profile, export)
+        
+            if lumin == False:
+                return
+        
+            filter_list = [nad, nir, red, grn, blu, pho, ste]
+            filter_names = ["ND", "IR", "RED", "GRN", "BLU", "P1", "S1"]
+        
+            profile.update(
+                dtype = 'uint16',
+                count = 1,
+                **output_options(fmt)
+            )
+        
+            for item, name in zip(filter_list, filter_names):
+                item = image_rows(item)
+                writer.submit(fname+"_"+name+ext, profile, item)
+        
+        return
 
-    if color == "IRB":
-        export = np.stack((nir, red, bgr))
+    @_holding_stages
+    def to_mastcam(self, fname, narrowband=True, queue_depth=4, fmt="png", percentile=None, sample=1):
         
-    elif color == "RGB":
-        #If RGB is requested, calculate synthetic blue filter according to HiRISE team formula
-        blu = (bgr * 2) - (red * 0.3)
-        #The blue channel tends to be bright, so applying an offset to simulate the I/F of blue
-        #light in CRISM.
-        blu += np.average(cube[:,:,0:10]) - np.average(blu)
-        export = np.stack((red, bgr, blu))
+        ##Data I/O and formatting
+        ext = output_extension(fmt)
+        profile = self.profile()
+        wave_range = [380, 1200]
         
-    elif color == "ENH":
-        enh_red = nir/red
-        enh_grn = nir/bgr
-        enh_blu = red/bgr
+        #Developer note: Mastcam filter responses are stored in the following order:
+        #[0] - wavelength
+        #[1-4] - bayer filters (blue, green, red)
+        #[4] - Left IR-bandcut
+        #[5-12] - Left narrowband filters (L1-L7)
+        #[12] - Right IR-bandcut
+        #[13:] - Right narrowband filters (R1-R7)
         
-        enh_red += np.average(enh_grn) - np.average(enh_red)
-        enh_blu += np.average(enh_grn) - np.average(enh_blu)
-        export = np.stack((enh_red, enh_grn, enh_blu))
+        filter_response = load_table("mastcam-response-mtrdr.txt", delimiter="\t")
         
-    else:
-        print("Invalid color keyword, use 'IRB' or 'RGB'.")
-    
-    export = (export - (np.amin(export) - (0.02*np.amin(export)))) / ((np.amax(export) + (0.02*np.amax(export))))    
-    export = convert_uint16(export)
-    
-    #Update profile for color export
-    profile.update(
-        dtype = rasterio.uint16,
-        count = 3,
-        driver = 'PNG'
-    )
-    
-    with rasterio.open(fname+"_"+color+".png", 'w', **profile) as out:
-                out.write(export)
-                
-    return
+        ##Calculate filter images filters via integration
+        
+        blue = self.filter_image(wave_range, filter_response[:, 1] * filter_response[:, 4])
+        green = self.filter_image(wave_range, filter_response[:, 2] * filter_response[:,4])
+        red = self.filter_image(wave_range, filter_response[:, 3] * filter_response[:,4])
+        
+        export = (red, green, blue)
+        export = stretch_rows(export, export_stretch(export, percentile, sample), percentile)
+        filter_name = "RGB"
+        
+        #Update profile for color export
+        profile.update(
+            dtype = 'uint16',
+            count = 3,
+            **output_options(fmt)
+        )
+        
+        with AsyncWriter(queue_depth) as writer:
+            writer.submit(fname+"_"+filter_name+ext, profile, export)
+        
+            if narrowband == False:
+                return
+        
+            #This section probably does not have the cleanest setup. Would prefer to execute this by iterating through 
+            #filters, but MastCam narrowband filters are obtained by discarding two of the Bayer filters (see Bell 
+            #et al. 2016 for documentation). The Bayer filters which get dropped change filter to filter, so I'm not 
+            #sure I can cleanly iterate through this in a loop.
+        
+            #The Bayer filters are effectively transparent in the NIR and are treated as identically transparent.
+            #Here I will emulate the interpolation by averaging the three Bayer filter bandpasses before applying 
+            #it to the narrowband filter.
+            bayer_response = np.average(filter_response[:, 1:4], axis=1)
+        
+            #Each filter image is integrated only when it is written, so the background writer can
+            #compress and write the previous filter image while the next one is being computed.
+            l1 = filter_response[:, 5] * filter_response[:,2]
+            l2 = filter_response[:, 6] * filter_response[:,1]
+            l3 = filter_response[:, 7] * filter_response[:,3]
+            l4 = filter_response[:, 8] * filter_response[:,3]
+            l5 = filter_response[:, 9] * bayer_response
+            l6 = filter_response[:, 10]* bayer_response
+        
+            r1 = filter_response[:,13] * filter_response[:,2]
+            r2 = filter_response[:,14] * filter_response[:,1]
+            r3 = filter_response[:,15] * filter_response[:,3]
+            r4 = filter_response[:, 16]* bayer_response
+            r5 = filter_response[:, 17]* bayer_response
+            r6 = filter_response[:, 18]* bayer_response
+        
+        
+            weight_list = [l1, l2, l3, l4, l5, l6, r1, r2, r3, r4, r5, r6]
+            filter_names = ["L1_527nm", "L2_445nm", "L3_751nm", "L4_676nm", "L5_867nm",
+                           "L6_1012nm", "R1_527nm", "R2_447nm", "R3_805nm", "R4_908nm",
+                           "R5_937nm", "R6_1013nm"]
+        
+            profile.update(
+                dtype = 'uint16',
+                count = 1,
+                **output_options(fmt)
+            )
+        
+            for weights, name in zip(weight_list, filter_names):
+                item = self.filter_image(wave_range, weights)
+                item = image_rows(item)
+                writer.submit(fname+"_"+name+ext, profile, item)
+        
+        return
 
+    @_holding_stages
+    def to_mastcamz(self, fname, narrowband=True, queue_depth=4, fmt="png", percentile=None, sample=1):
+        
+        ##Data I/O and formatting
+        ext = output_extension(fmt)
+        profile = self.profile()
+        wave_range = [380, 1100]
+        
+        #Developer note: Mastcam filter responses are stored in the following order:
+        #[0] - wavelength
+        #[1-4] - bayer filters (blue, green, red)
+        #[4-10] - Left narrowband filters (L1-L6)
+        #[10:] - Right narrowband filters (R2-R7) (R1 is duplicate of L1 and not included)
+        
+        #Filter responses are adapted from Hayes et al. 2021 (Pre-Flight Calibration of the Mars
+        #2020 Rover Mastcam Zoom (Mastcam-Z) Multispectral Stereoscopic Imager). In-band responses
+        #were primarily used, with out-of-band responses added when these responses were within an 
+        #order of magnitude of peak response.
+        
+        filter_response = load_table("mastcamz-response-mtrdr.txt", delimiter="\t")
+        
+        ##Calculate filter images filters via integration
+        
+        blue = self.filter_image(wave_range, filter_response[:, 1])
+        green = self.filter_image(wave_range, filter_response[:, 2])
+        red = self.filter_image(wave_range, filter_response[:, 3])
+        
+        export = (red, green, blue)
+        print(export)
+        export = stretch_rows(export, export_stretch(export, percentile, sample), percentile)
+        filter_name = "RGB"
+        
+        #Update profile for color export
+        profile.update(
+            dtype = 'uint16',
+            count = 3,
+            **output_options(fmt)
+        )
+        
+        with AsyncWriter(queue_depth) as writer:
+            writer.submit(fname+"_"+filter_name+ext, profile, export)
+        
+            if narrowband == False:
+                return
+        
+            #Unlike the Mastcam setup, where filter calibrations did not account for the Bayer filter,
+            #the Mastcam-Z files provided the filter response through each of the red, green, and blue Bayer
+            #filters. L6 uses only the blue Bayer response, L5 the green Bayer response, and L4 and L3 the 
+            #red Bayer response. 
+        
+            #I am assuming that the NIR filters take the same approach used on Mastcam and simply treat the 
+            #Bayer filters as more or less equally transparent for the purposes of Bayer interpolation. The 
+            #filter response files averaged the filter responses of the convolved NIR and Bayer filters. 
+        
+            #Happy to change this if it is incorrect!
+        
+            #Each filter image is integrated only when it is written, so the background writer can
+            #compress and write the previous filter image while the next one is being computed.
+            weight_list = [filter_response[:, column] for column in range(4, 15)]
+            filter_names = ["L1_800nm", "L2_754nm", "L3_677nm", "L4_605nm", "L5_528nm",
+                           "L6_442nm", "R2_866nm", "R3_910nm", "R4_939nm",
+                           "R5_978nm", "R6_1022nm"]
+        
+            profile.update(
+                dtype = 'uint16',
+                count = 1,
+                **output_options(fmt)
+            )
+        
+            for weights, name in zip(weight_list, filter_names):
+                item = self.filter_image(wave_range, weights)
+                item = image_rows(item)
+                writer.submit(fname+"_"+name+ext, profile, item)
+        
+        return
 
-def mtrdr_to_hrsc(file, fname, color="IGB", lumin=False):
-    
-    ##Data I/O and formatting
-    with rasterio.open(file) as src:
-        profile = src.profile
-        cube = src.read()
-    
-    cube = format_mtrdr(cube)
-    cube = mtrdr_crop_bands(cube, [380, 1100])
-    cube = cube.transpose(1,2,0)
-    cube = np.ma.masked_values(cube, 65535)
-    
-    #Developer note: HRSC filter responses are stored in the following order:
-    #[0] - MTRDR wavelength; [1] - Nadir; [2] - NIR; [3] - Red; [4] - Green; [5] - Blue;
-    #[6] - Photometry; [7] - Stereo
-    
-    #Approximately 15% of the light entering the HRSC blue filter in the N-UV is not visible
-    #to CRISM, so the filter response is a little different from reality.
-    
-    #Filter information retrieved from the Spanish Virtual Observatory Filter Profile Repository
-    filter_response = np.genfromtxt("matching_functions/hrsc-response-mtrdr.txt", delimiter="\t")
-    
-    ##Calculate filter images filters via integration
-    
-    nad = calculate_luminance((filter_response[:, 1]), cube)
-    nir = calculate_luminance((filter_response[:, 2]), cube)
-    red = calculate_luminance((filter_response[:, 3]), cube)
-    grn = calculate_luminance((filter_response[:, 4]), cube)
-    blu = calculate_luminance((filter_response[:, 5]), cube)
-    pho = calculate_luminance((filter_response[:, 6]), cube)
-    ste = calculate_luminance((filter_response[:, 7]), cube)
-    
-    if color == "IGB":
-        export = np.stack((nir, grn, blu))
+    @_holding_stages
+    def to_pancam(self, fname, color="RGB", narrowband=True, queue_depth=4, fmt="png", percentile=None, sample=1):
         
-    elif color == "IRB":
-        export = np.stack((nir, red, blu))
+        ##Data I/O and formatting
+        ext = output_extension(fmt)
+        profile = self.profile()
+        wave_range = [380, 1150]
         
-    elif color == "RGB":
-        export = np.stack((red, grn, blu))
+        #Developer note: PanCam filter responses are stored in the following order:
+        #[0] - MTRDR wavelength; [1:8] - L1-L7; [8:] - R1-R7
+        
+        #Filter information retrieved from the Spanish Virtual Observatory Filter Profile Repository
+        filter_response = load_table("pancam-response-mtrdr.txt", delimiter="\t")
+        
+        ##Calculate filter images filters via integration
+        
+        l1 = self.filter_image(wave_range, filter_response[:, 1])
+        l2 = self.filter_image(wave_range, filter_response[:, 2])
+        l3 = self.filter_image(wave_range, filter_response[:, 3])
+        l4 = self.filter_image(wave_range, filter_response[:, 4])
+        l5 = self.filter_image(wave_range, filter_response[:, 5])
+        l6 = self.filter_image(wave_range, filter_response[:, 6])
+        l7 = self.filter_image(wave_range, filter_response[:, 7])
+        r1 = self.filter_image(wave_range, filter_response[:, 8])
+        r2 = self.filter_image(wave_range, filter_response[:, 9])
+        r3 = self.filter_image(wave_range, filter_response[:, 10])
+        r4 = self.filter_image(wave_range, filter_response[:, 11])
+        r5 = self.filter_image(wave_range, filter_response[:, 12])
+        r6 = self.filter_image(wave_range, filter_response[:, 13])
+        r7 = self.filter_image(wave_range, filter_response[:, 14])
+        
+        if color == "RGB":
+            export = (l3, l5, l7)
+            
+        elif color == "IRB":
+            export = (l2, l5, l7)
+            
+        else:
+            print("Invalid color keyword, use 'RGB' or 'IRB'.")
+        
+        export = stretch_rows(export, export_stretch(export, percentile, sample), percentile)
+        
+        #Update profile for color export
+        profile.update(
+            dtype = 'uint16',
+            count = 3,
+            **output_options(fmt)
+        )
+        
+        with AsyncWriter(queue_depth) as writer:
+            writer.submit(fname+"_"+color+ext, profile, export)
+        
+            if narrowband == False:
+                return
+        
+            filter_list = [l1, l2, l3, l4, l5, l6, l7, r1, r2, r3, r4, r5, r6, r7]
+            filter_names = ["L1_PAN", "L2_750nm", "L3_670nm", "L4_600nm", "L5_530nm", "L6_480nm", "L7_430nm",
+                           "R1_430nm", "R2_750nm", "R3_800nm", "R4_860nm", "R5_900nm", "R6_930nm", "R7_980nm"]
+        
+            profile.update(
+                dtype = 'uint16',
+                count = 1,
+                **output_options(fmt)
+            )
+        
+            for item, name in zip(filter_list, filter_names):
+                item = image_rows(item)
+                writer.submit(fname+"_"+name+ext, profile, item)
         
-    else:
-        print("Invalid color keyword, use 'IGB', 'IRB', or 'RGB'.")
-    
-    export = (export - (np.amin(export) - (0.02*np.amin(export)))) / ((np.amax(export) + (0.02*np.amax(export))))    
-    export = convert_uint16(export)
-    
-    #Update profile for color export
-    profile.update(
-        dtype = rasterio.uint16,
-        count = 3,
-        driver = 'PNG'
-    )
-    
-    with rasterio.open(fname+"_"+color+".png", 'w', **profile) as out:
-                out.write(export)
-    
-    if lumin == False:
         return
-    
-    filter_list = [nad, nir, red, grn, blu, pho, ste]
-    filter_names = ["ND", "IR", "RED", "GRN", "BLU", "P1", "S1"]
-    
-    profile.update(
-        dtype = rasterio.uint16,
-        count = 1,
-        driver = 'PNG'
-    )
-    
-    for item, name in zip(filter_list, filter_names):
-        item = np.expand_dims(item, 0)
-        item = convert_uint16(item)
-        with rasterio.open(fname+"_"+name+".png", 'w', **profile) as out:
-                out.write(item)
-                
-    return
 
+    @_holding_stages
+    def to_zarr(self, fname, wave_range=(380, 1100), tile=512, workers=4):
+        """Exports the calibrated spectral cube of the scene to a chunked Zarr store.
+
+        The cube is gap-filled with format_mtrdr(), cropped to wave_range and whiteflat
+        corrected as in the color pipeline, and written to fname+".zarr" as the float32 array
+        "cube" (band, y, x) chunked into spatial tiles of tile x tile pixels with all bands,
+        next to the array "wavelength" from modify_mtrdr_axis(). Null pixels are stored as
+        NaN. Each tile is read from the file, calibrated and written by one of `workers`
+        threads instead of going through the cached stages, so the full cube never has to be
+        held in memory. Requires the zarr package."""
+
+        try:
+            import zarr
+        except ImportError:
+            print("Error: mtrdr_to_zarr() requires the zarr package, install it with: python3 -m pip install zarr")
+            return
+
+        import rasterio
+
+        mtrdr_axis = modify_mtrdr_axis()
+        short = find_band(mtrdr_axis, wave_range[0])
+        long = find_band(mtrdr_axis, wave_range[1])
+        bands = mtrdr_source_bands(wave_range)
+        profile = self.profile()
+
+        store = zarr.open_group(fname+".zarr", mode='w')
+        cube = store.full(name="cube", shape=(long - short, profile['height'], profile['width']),
+                          chunks=(long - short, tile, tile), dtype="float32", fill_value=np.nan)
+        wavelength = store.zeros(name="wavelength", shape=(long - short,), dtype="float64")
+        wavelength[:] = mtrdr_axis[short:long]
+        store.attrs.update(source=os.path.basename(self.file), crs=profile['crs'].to_wkt() if profile['crs'] else None,
+                           transform=list(profile['transform'])[:6], wavelength_units="nm")
+
+        def export_tile(row, col):
+            window = rasterio.windows.Window(col, row, min(tile, profile['width'] - col),
+                                             min(tile, profile['height'] - row))
+            #Datasets can't be shared between threads, so every tile opens its own and reads
+            #only the leading bands needed for wave_range
+            with rasterio.open(self.file) as src:
+                img = src.read(indexes=list(range(1, bands + 1)), window=window)
+            img[(img < 0) | (img >= 1)] = np.nan
+            img = whiteflat_correct(mtrdr_crop_bands(format_mtrdr(img), wave_range))
+            cube[:, row:row + img.shape[1], col:col + img.shape[2]] = img.astype(np.float32)
+
+        pool = ThreadPoolExecutor(max_workers=workers)
+        futures = [pool.submit(export_tile, row, col)
+                   for row in range(0, profile['height'], tile)
+                   for col in range(0, profile['width'], tile)]
+        pool.shutdown(wait=True)
+        for future in futures:
+            future.result()
+        return
 
-def mtrdr_to_mastcam(file, fname, narrowband=True):
-    
-    ##Data I/O and formatting
-    with rasterio.open(file) as src:
-        profile = src.profile
-        cube = src.read()
-    
-    cube = format_mtrdr(cube)
-    cube = mtrdr_crop_bands(cube, [380, 1200])
-    cube = cube.transpose(1,2,0)
-    cube = np.ma.masked_values(cube, 65535)
-    
-    #Developer note: Mastcam filter responses are stored in the following order:
-    #[0] - wavelength
-    #[1-4] - bayer filters (blue, green, red)
-    #[4] - Left IR-bandcut
-    #[5-12] - Left narrowband filters (L1-L7)
-    #[12] - Right IR-bandcut
-    #[13:] - Right narrowband filters (R1-R7)
-    
-    filter_response = np.genfromtxt("matching_functions/mastcam-response-mtrdr.txt", delimiter="\t")
-    
-    ##Calculate filter images filters via integration
-    
-    blue = calculate_luminance((filter_response[:, 1] * filter_response[:, 4]), cube)
-    green = calculate_luminance((filter_response[:, 2] * filter_response[:,4]), cube)
-    red = calculate_luminance((filter_response[:, 3] * filter_response[:,4]), cube)
-    
-    export = np.stack((red, green, blue))
-    export = (export - (np.amin(export) - (0.02*np.amin(export)))) / ((np.amax(export) + (0.02*np.amax(export))))
-    filter_name = "RGB"
-    
-    export = convert_uint16(export)
-    
-    #Update profile for color export
-    profile.update(
-        dtype = rasterio.uint16,
-        count = 3,
-        driver = 'PNG'
-    )
-    
-    with rasterio.open(fname+"_"+filter_name+".png", 'w', **profile) as out:
-                out.write(export)
-    
-    if narrowband == False:
+    @_holding_stages
+    def whiteflat_sweep(self, name, candidates, region=None, mode="raw", batch=8, thumb=256, queue_depth=4, fmt="png"):
+        """Renders the VIS color product with each of several whiteflat candidate spectra.
+
+        The whiteflat correction scales every band, so it is folded into the color matching
+        and luminance operators: the gap-filled cube is integrated with the operators of
+        `batch` candidates in a single matrix product instead of being corrected and
+        rendered once per candidate. Each candidate image gets its own stretch, as
+        mtrdr_to_color() with that whiteflat file would give. Besides the images, a contact
+        sheet of thumbnails (row by row in candidate order) and a CSV file with the flatness
+        of the corrected mean spectrum over region, [row, col, height, width] or by default
+        the whole scene, are written."""
+
+        if isinstance(candidates, str):
+            if os.path.isdir(candidates):
+                candidates = os.path.join(candidates, "*.csv")
+            candidates = sorted(glob.glob(candidates))
+        if not candidates:
+            print("Error: no whiteflat candidate files found.")
+            return
+        ext = output_extension(fmt)
+        profile = self.profile()
+        profile.update(
+            dtype = 'uint16',
+            count = 3,
+            **output_options(fmt)
+        )
+
+        wave_range = [380, 780]
+        cube = mtrdr_crop_bands(self.filled(clamp=True), wave_range)
+        bands, rows, cols = cube.shape
+        spectra = cube.reshape(bands, rows*cols).T
+        band_means = np.mean(cube, axis=(1,2))
+        factors = np.stack([mtrdr_whiteflat(bands, file=candidate) for candidate in candidates])
+
+        #As in color_from_cube(), all three luminance images use flat weights
+        weights = np.ones(bands)
+        cmf = mtrdr_color_matching(wave_range)
+        cs = colour_system("srgb")
+
+        #Mean spectrum over the valid pixels of the reference region
+        if region is None:
+            region = [0, 0, rows, cols]
+        if len(region) != 4:
+            raise ValueError("Invalid region, use [row, col, height, width].")
+        row, col, height, width = region
+        window = (slice(row, row + height), slice(col, col + width))
+        raw = self.raw()
+        valid = (raw[0][window] >= 0) & (raw[0][window] < 1)
+        if not np.any(valid):
+            raise ValueError("The reference region has no valid pixels.")
+        region_means = cube[(slice(None),) + window][:, valid].mean(axis=1)
+        mtrdr_axis = modify_mtrdr_axis()
+        short = find_band(mtrdr_axis, wave_range[0])
+        wavelengths = mtrdr_axis[short:short + bands]
+
+        with AsyncWriter(queue_depth) as writer:
+            scale = max(1, int(np.ceil(max(rows, cols) / thumb)))
+            thumbs = []
+            stats = []
+
+            for start in range(0, len(candidates), max(1, batch)):
+                group = factors[start:start + max(1, batch)]
+
+                #Per candidate three color matching columns and one luminance column, scaled by
+                #the candidate's whiteflat factors
+                operator = np.concatenate((group[:, :, np.newaxis] * cmf, group[:, :, np.newaxis] / bands), axis=2)
+                integrated = spectra.dot(operator.transpose(1, 0, 2).reshape(bands, -1)).reshape(rows*cols, len(group), 4)
+
+                for index in range(len(group)):
+                    number = start + index
+                    offset = luminance_offset(weights, factors[number] * band_means)
+                    lumin = integrated[:, index, 3].reshape(rows, cols) + offset
+                    lumin_min, lumin_max = np.amin(lumin), np.amax(lumin)
+                    lumin = (lumin - (lumin_min - (0.02*lumin_min))) / ((lumin_max + (0.02*lumin_max)))
+                    rgb = cs.tristimulus_to_rgb(integrated[:, index, 0:3].copy())
+                    image = shade_color(rgb, np.stack((lumin, lumin, lumin)), mode=mode)
+
+                    stem = os.path.splitext(os.path.basename(candidates[number]))[0]
+                    writer.submit(name+"_VIS_"+str(number).zfill(2)+"_"+stem+ext, profile, image)
+                    thumbs.append(image[:, ::scale, ::scale].copy())
+
+                    #Flatness of the corrected mean spectrum, and the mean color of the region
+                    spectrum = factors[number] * region_means
+                    mean = np.mean(spectrum)
+                    slope = np.polyfit(wavelengths, spectrum / mean, 1)[0] * 100
+                    color = image[(slice(None),) + window][:, valid].mean(axis=1) / 65535
+                    stats.append([number, candidates[number], np.std(spectrum) / mean, slope,
+                                  np.amax(spectrum) / np.amin(spectrum), color[0], color[1], color[2],
+                                  (np.amax(color) - np.amin(color)) / np.mean(color)])
+                del integrated
+
+            #Contact sheet with 4 pixel gaps between the thumbnails
+            columns = int(np.ceil(np.sqrt(len(thumbs))))
+            sheet_rows = int(np.ceil(len(thumbs) / columns))
+            height, width = thumbs[0].shape[1:]
+            sheet = np.zeros((3, sheet_rows * (height + 4) - 4, columns * (width + 4) - 4), dtype=np.uint16)
+            for number, image in enumerate(thumbs):
+                top = (number // columns) * (height + 4)
+                left = (number % columns) * (width + 4)
+                sheet[:, top:top + height, left:left + width] = image
+        sheet_profile = dict(dtype='uint16', count=3, height=sheet.shape[1], width=sheet.shape[2], **output_options(fmt))
+        import rasterio
+        with warnings.catch_warnings():
+            #The contact sheet isn't a map
+            warnings.simplefilter("ignore", rasterio.errors.NotGeoreferencedWarning)
+            write_raster(name+"_VIS_sweep"+ext, sheet_profile, sheet)
+
+        with open(name+"_VIS_sweep.csv", "w") as out:
+            out.write("candidate,file,spectrum_cv,slope_per_100nm,max_min_ratio,mean_red,mean_green,mean_blue,color_spread\n")
+            for line in stats:
+                out.write(",".join(str(value) for value in line[0:2]) + "," + ",".join("%.6g" % value for value in line[2:]) + "\n")
         return
-    
-    #This section probably does not have the cleanest setup. Would prefer to execute this by iterating through 
-    #filters, but MastCam narrowband filters are obtained by discarding two of the Bayer filters (see Bell 
-    #et al. 2016 for documentation). The Bayer filters which get dropped change filter to filter, so I'm not 
-    #sure I can cleanly iterate through this in a loop.
-    
-    #The Bayer filters are effectively transparent in the NIR and are treated as identically transparent.
-    #Here I will emulate the interpolation by averaging the three Bayer filter bandpasses before applying 
-    #it to the narrowband filter.
-    bayer_response = np.average(filter_response[:, 1:4], axis=1)
-    
-    l1 = calculate_luminance((filter_response[:, 5] * filter_response[:,2]), cube)
-    l2 = calculate_luminance((filter_response[:, 6] * filter_response[:,1]), cube)
-    l3 = calculate_luminance((filter_response[:, 7] * filter_response[:,3]), cube)
-    l4 = calculate_luminance((filter_response[:, 8] * filter_response[:,3]), cube)
-    l5 = calculate_luminance((filter_response[:, 9] * bayer_response), cube)
-    l6 = calculate_luminance((filter_response[:, 10]* bayer_response), cube)
-    
-    r1 = calculate_luminance((filter_response[:,13] * filter_response[:,2]), cube)
-    r2 = calculate_luminance((filter_response[:,14] * filter_response[:,1]), cube)
-    r3 = calculate_luminance((filter_response[:,15] * filter_response[:,3]), cube)
-    r4 = calculate_luminance((filter_response[:, 16]* bayer_response), cube)
-    r5 = calculate_luminance((filter_response[:, 17]* bayer_response), cube)
-    r6 = calculate_luminance((filter_response[:, 18]* bayer_response), cube)
-    
-    
-    filter_list = [l1, l2, l3, l4, l5, l6, r1, r2, r3, r4, r5, r6]
-    filter_names = ["L1_527nm", "L2_445nm", "L3_751nm", "L4_676nm", "L5_867nm",
-                   "L6_1012nm", "R1_527nm", "R2_447nm", "R3_805nm", "R4_908nm",
-                   "R5_937nm", "R6_1013nm"]
-    
-    profile.update(
-        dtype = rasterio.uint16,
-        count = 1,
-        driver = 'PNG'
-    )
-    
-    for item, name in zip(filter_list, filter_names):
-        item = np.expand_dims(item, 0)
-        item = convert_uint16(item)
-        with rasterio.open(fname+"_"+name+".png", 'w', **profile) as out:
-                out.write(item)
-                
-    return
 
+#The mtrdr_to_* functions render one product of a file through an MtrdrScene, so calling
+#several of them on the same file reuses the cached stages of the previous calls.
 
-def mtrdr_to_mastcamz(file, fname, narrowband=True):
-    
-    ##Data I/O and formatting
-    with rasterio.open(file) as src:
-        profile = src.profile
-        cube = src.read()
-    
-    cube = format_mtrdr(cube)
-    cube = mtrdr_crop_bands(cube, [380, 1100])
-    cube = cube.transpose(1,2,0)
-    cube = np.ma.masked_values(cube, 65535)
-    
-    #Developer note: Mastcam filter responses are stored in the following order:
-    #[0] - wavelength
-    #[1-4] - bayer filters (blue, green, red)
-    #[4-10] - Left narrowband filters (L1-L6)
-    #[10:] - Right narrowband filters (R2-R7) (R1 is duplicate of L1 and not included)
-    
-    #Filter responses are adapted from Hayes et al. 2021 (Pre-Flight Calibration of the Mars
-    #2020 Rover Mastcam Zoom (Mastcam-Z) Multispectral Stereoscopic Imager). In-band responses
-    #were primarily used, with out-of-band responses added when these responses were within an 
-    #order of magnitude of peak response.
-    
-    filter_response = np.genfromtxt("matching_functions/mastcamz-response-mtrdr.txt", delimiter="\t")
-    
-    ##Calculate filter images filters via integration
-    
-    blue = calculate_luminance(filter_response[:, 1], cube)
-    green = calculate_luminance(filter_response[:, 2], cube)
-    red = calculate_luminance(filter_response[:, 3], cube)
-    
-    export = np.stack((red, green, blue))
-    print(export)
-    export = (export - (np.amin(export) - (0.02*np.amin(export)))) / ((np.amax(export) + (0.02*np.amax(export))))
-    filter_name = "RGB"
-    
-    export = convert_uint16(export)
-    
-    #Update profile for color export
-    profile.update(
-        dtype = rasterio.uint16,
-        count = 3,
-        driver = 'PNG'
-    )
-    
-    with rasterio.open(fname+"_"+filter_name+".png", 'w', **profile) as out:
-                out.write(export)
-    
-    if narrowband == False:
+def mtrdr_to_color(file, name, standard_params=True, new_params=None, queue_depth=4, fmt="png", stream=False,
+                   percentile=None, sample=1):
+    """Function to produce perceptually-accurate color from CRISM MTRDR data."""
+    MtrdrScene(file).to_color(name, standard_params, new_params, queue_depth, fmt, stream, percentile, sample)
+
+def mtrdr_to_cassis(file, fname, color="IPB", fmt="png", percentile=None, sample=1):
+    MtrdrScene(file).to_cassis(fname, color, fmt, percentile, sample)
+
+def mtrdr_to_hirise(file, fname, color="IRB", fmt="png", percentile=None, sample=1):
+    MtrdrScene(file).to_hirise(fname, color, fmt, percentile, sample)
+
+def mtrdr_to_hrsc(file, fname, color="IGB", lumin=False, queue_depth=4, fmt="png", percentile=None, sample=1):
+    MtrdrScene(file).to_hrsc(fname, color, lumin, queue_depth, fmt, percentile, sample)
+
+def mtrdr_to_mastcam(file, fname, narrowband=True, queue_depth=4, fmt="png", percentile=None, sample=1):
+    MtrdrScene(file).to_mastcam(fname, narrowband, queue_depth, fmt, percentile, sample)
+
+def mtrdr_to_mastcamz(file, fname, narrowband=True, queue_depth=4, fmt="png", percentile=None, sample=1):
+    MtrdrScene(file).to_mastcamz(fname, narrowband, queue_depth, fmt, percentile, sample)
+
+def mtrdr_to_pancam(file, fname, color="RGB", narrowband=True, queue_depth=4, fmt="png", percentile=None, sample=1):
+    MtrdrScene(file).to_pancam(fname, color, narrowband, queue_depth, fmt, percentile, sample)
+
+def mtrdr_to_zarr(file, fname, wave_range=(380, 1100), tile=512, workers=4):
+    """Exports the calibrated spectral cube of an MTRDR image to a chunked Zarr store, see
+    MtrdrScene.to_zarr()."""
+    MtrdrScene(file).to_zarr(fname, wave_range, tile, workers)
+
+def mtrdr_whiteflat_sweep(file, name, candidates, region=None, mode="raw", batch=8, thumb=256, queue_depth=4, fmt="png"):
+    """Renders the VIS color product of file once per whiteflat candidate file, given as a
+    list, a glob pattern or a directory of CSV files. See MtrdrScene.whiteflat_sweep()."""
+    MtrdrScene(file).whiteflat_sweep(name, candidates, region, mode, batch, thumb, queue_depth, fmt)
+
+
+def mtrdr_batch(directory, product="mtrdr_to_color", prefetch=1, pattern="*if*mtr3*lbl", **params):
+    """Runs a mtrdr_to_* product on every MTRDR image in a directory tree.
+
+    While one scene is rendered, a background reader already loads the next `prefetch`
+    scenes, so disk (or NFS) reads overlap with the computation instead of adding to it.
+    Only the leading bands up to PRODUCT_WAVE_RANGE, those all built-in products need, are
+    read. Each scene in flight holds them in memory, so keep prefetch small. With
+    stream=True nothing is prefetched, as the products then read the cubes block by block.
+    Outputs are named after the input files, as in crismcal.sh. Extra keyword arguments
+    are passed on to the product function."""
+
+    if not product.startswith("mtrdr_to_") or product not in globals():
+        print("Invalid product, use one of the mtrdr_to_* functions, e.g. 'mtrdr_to_color'.")
         return
-    
-    #Unlike the Mastcam setup, where filter calibrations did not account for the Bayer filter,
-    #the Mastcam-Z files provided the filter response through each of the red, green, and blue Bayer
-    #filters. L6 uses only the blue Bayer response, L5 the green Bayer response, and L4 and L3 the 
-    #red Bayer response. 
-    
-    #I am assuming that the NIR filters take the same approach used on Mastcam and simply treat the 
-    #Bayer filters as more or less equally transparent for the purposes of Bayer interpolation. The 
-    #filter response files averaged the filter responses of the convolved NIR and Bayer filters. 
-    
-    #Happy to change this if it is incorrect!
-    
-    l1 = calculate_luminance(filter_response[:, 4], cube)
-    l2 = calculate_luminance(filter_response[:, 5], cube)
-    l3 = calculate_luminance(filter_response[:, 6], cube)
-    l4 = calculate_luminance(filter_response[:, 7], cube)
-    l5 = calculate_luminance(filter_response[:, 8], cube)
-    l6 = calculate_luminance(filter_response[:, 9], cube)
-
-    r2 = calculate_luminance(filter_response[:,10], cube)
-    r3 = calculate_luminance(filter_response[:,11], cube)
-    r4 = calculate_luminance(filter_response[:, 12], cube)
-    r5 = calculate_luminance(filter_response[:, 13], cube)
-    r6 = calculate_luminance(filter_response[:, 14], cube)
-    
-    
-    filter_list = [l1, l2, l3, l4, l5, l6, r2, r3, r4, r5, r6]
-    filter_names = ["L1_800nm", "L2_754nm", "L3_677nm", "L4_605nm", "L5_528nm",
-                   "L6_442nm", "R2_866nm", "R3_910nm", "R4_939nm",
-                   "R5_978nm", "R6_1022nm"]
-    
-    profile.update(
-        dtype = rasterio.uint16,
-        count = 1,
-        driver = 'PNG'
-    )
-    
-    for item, name in zip(filter_list, filter_names):
-        item = np.expand_dims(item, 0)
-        item = convert_uint16(item)
-        with rasterio.open(fname+"_"+name+".png", 'w', **profile) as out:
-                out.write(item)
-                
+    render = globals()[product]
+
+    files = sorted(glob.glob(os.path.join(directory, "**", pattern), recursive=True))
+    reader = ThreadPoolExecutor(max_workers=1)
+    loading = collections.deque()
+    queued = 0
+    failed = 0
+
+    for file in files:
+        #Keep the current scene plus up to `prefetch` following scenes in flight
+        while not params.get("stream") and queued < len(files) and len(loading) <= max(0, prefetch):
+            loading.append(reader.submit(load_mtrdr, files[queued], mtrdr_product_bands()))
+            queued += 1
+
+        print("processing "+file+"...")
+        try:
+            if loading:
+                loaded = loading.popleft().result()
+                with _prefetched_lock:
+                    _prefetched[file] = loaded
+                del loaded
+            render(file, file, **params)
+        except Exception as error:
+            print("Error: "+file+": "+str(error))
+            failed += 1
+        finally:
+            with _prefetched_lock:
+                _prefetched.pop(file, None)
+            #Every scene is rendered once, don't keep its stages around
+            MtrdrScene(file).forget()
+
+    reader.shutdown(wait=True)
+    print("processed "+str(len(files) - failed)+" of "+str(len(files))+" images")
     return
 
+#Shared-filesystem work queue
+
+class WorkQueue:
+    """A work queue of the MTRDR images in a directory tree, kept in the queue directory on the
+    shared filesystem, so that any number of worker() processes on any number of hosts can
+    render them without a coordinator.
+
+    A worker claims an image by creating claims/<image>.claim with O_EXCL, which only one of
+    them can do, and refreshes the modification time of the claim as a heartbeat while
+    rendering. Claims whose heartbeat is older than `stale` seconds, by the clock of the
+    filesystem, are from crashed workers: they are moved away with an atomic rename and
+    claimed again. Finished images get a JSON record in done/ or failed/."""
+
+    def __init__(self, directory, queue=None, pattern="*if*mtr3*lbl", stale=120):
+        import socket
+        self.directory = directory
+        self.pattern = pattern
+        self.stale = stale
+        self.queue = queue or os.path.join(directory, ".crism-queue")
+        self.host = socket.gethostname()
+        self.worker_id = self.host+"-"+str(os.getpid())
+        for name in ("claims", "done", "failed", "workers"):
+            os.makedirs(os.path.join(self.queue, name), exist_ok=True)
+
+    def files(self):
+        """Returns the images of the directory tree."""
+        return sorted(glob.glob(os.path.join(self.directory, "**", self.pattern), recursive=True))
+
+    def key(self, file):
+        """Returns the record name of an image: its path in the directory tree with / escaped."""
+        return os.path.relpath(file, self.directory).replace("%", "%25").replace(os.sep, "%2F")
+
+    def path(self, kind, key):
+        if kind == "claims":
+            return os.path.join(self.queue, kind, key+".claim")
+        return os.path.join(self.queue, kind, key+".json")
+
+    def now(self):
+        """Touches the heartbeat file of this worker and returns its modification time, the
+        current time of the shared filesystem, which other hosts' clocks may differ from."""
+        path = os.path.join(self.queue, "workers", self.worker_id)
+        with open(path, "a"):
+            pass
+        os.utime(path)
+        return os.stat(path).st_mtime
+
+    def leave(self):
+        """Removes the heartbeat file of this worker, when it stops working on the queue."""
+        try:
+            os.remove(os.path.join(self.queue, "workers", self.worker_id))
+        except FileNotFoundError:
+            pass
+
+    def state(self, key):
+        """Returns "done" or "failed" for finished images, otherwise None."""
+        for kind in ("done", "failed"):
+            if os.path.exists(self.path(kind, key)):
+                return kind
+        return None
+
+    def _token(self, path):
+        try:
+            with open(path) as claim:
+                return json.load(claim).get("token")
+        except (OSError, ValueError):
+            return None
+
+    def claim(self, key):
+        """Claims an image, returns the token identifying the claim, or None if another
+        worker holds a live claim."""
+        path = self.path("claims", key)
+        token = self.worker_id+"-"+str(time.time())
+        for attempt in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                if attempt == 0 and self._reclaim(path):
+                    continue
+                return None
+            with os.fdopen(fd, "w") as claim:
+                json.dump(dict(token=token, worker=self.worker_id, host=self.host, pid=os.getpid(), claimed=time.time()), claim)
+            return token
+        return None
+
+    def _reclaim(self, path):
+        """Removes a stale claim, returns True if the image can be claimed again."""
+        try:
+            token = self._token(path)
+            heartbeat = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return True
+        if self.now() - heartbeat < self.stale:
+            return False
+
+        #Only one of the workers finding the stale claim can rename it away. If it was renewed
+        #or replaced between the check and the rename, put it back.
+        moved = path+"."+self.worker_id+".stale"
+        try:
+            os.rename(path, moved)
+        except FileNotFoundError:
+            return True
+        if self._token(moved) != token or self.now() - os.stat(moved).st_mtime < self.stale:
+            try:
+                os.link(moved, path)
+            except FileExistsError:
+                pass
+            os.remove(moved)
+            return False
+        os.remove(moved)
+        print("reclaimed the stale claim "+os.path.basename(path))
+        return True
+
+    def heartbeat(self, key, token):
+        """Refreshes a claim, returns False if it has been lost to another worker."""
+        path = self.path("claims", key)
+        if self._token(path) != token:
+            return False
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        self.now()
+        return True
+
+    def finish(self, key, token, record, failed=False):
+        """Stores the done or failed record of an image and releases its claim."""
+        tmp = os.path.join(self.queue, "done" if not failed else "failed", "."+key+"."+self.worker_id+".tmp")
+        with open(tmp, "w") as out:
+            json.dump(record, out, indent=1)
+        os.replace(tmp, self.path("done" if not failed else "failed", key))
+        if not failed and os.path.exists(self.path("failed", key)):
+            os.remove(self.path("failed", key))
+        self.release(key, token)
+
+    def release(self, key, token):
+        """Removes a claim if it is still ours."""
+        path = self.path("claims", key)
+        if self._token(path) == token:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def summary(self):
+        """Aggregates the records of the queue into summary.json and returns the summary."""
+        files = self.files()
+        keys = set(self.key(file) for file in files)
+        records = {}
+        for kind in ("done", "failed"):
+            records[kind] = []
+            for path in sorted(glob.glob(os.path.join(self.queue, kind, "*.json"))):
+                if os.path.basename(path)[:-5] in keys:
+                    try:
+                        with open(path) as record:
+                            records[kind].append(json.load(record))
+                    except (OSError, ValueError):
+                        pass
+        running = [os.path.basename(path)[:-6] for path in glob.glob(os.path.join(self.queue, "claims", "*.claim"))]
+        running = [key for key in running if key in keys and self.state(key) is None]
+
+        workers = {}
+        for record in records["done"] + records["failed"]:
+            workers[record["worker"]] = workers.get(record["worker"], 0) + 1
+        summary = dict(directory=os.path.abspath(self.directory), total=len(files),
+                       done=len(records["done"]), failed=len(records["failed"]), running=len(running),
+                       pending=len(files) - len(records["done"]) - len(records["failed"]) - len(running),
+                       render_seconds=round(sum(record["elapsed"] for record in records["done"] + records["failed"]), 3),
+                       outputs=sum(len(record["outputs"]) for record in records["done"]),
+                       workers=workers,
+                       failures=[dict(file=record["file"], worker=record["worker"], error=record["error"]) for record in records["failed"]])
+
+        tmp = os.path.join(self.queue, ".summary."+self.worker_id+".tmp")
+        with open(tmp, "w") as out:
+            json.dump(summary, out, indent=1)
+        os.replace(tmp, os.path.join(self.queue, "summary.json"))
+        return summary
+
+def _print_summary(summary):
+    print(str(summary["done"])+" done, "+str(summary["failed"])+" failed, "+str(summary["running"])+" running, "
+          +str(summary["pending"])+" pending of "+str(summary["total"])+" images")
+    for failure in summary["failures"]:
+        print("Error: "+failure["file"]+": "+str(failure["error"]))
+
+def worker(directory, product="mtrdr_to_color", queue=None, pattern="*if*mtr3*lbl", heartbeat=30, stale=120, retry_failed=False, **params):
+    """Renders the MTRDR images of a directory tree from a work queue on a shared filesystem.
+
+    Start any number of workers, on any hosts mounting the directory, to share the images
+    between them; see WorkQueue. The queue is kept in directory/.crism-queue unless queue is
+    given. While rendering, a worker refreshes its claim every `heartbeat` seconds; claims not
+    refreshed for `stale` seconds are taken over by other workers. Images which failed are
+    only tried again with retry_failed. When no image is left, the worker aggregates the
+    records into summary.json in the queue directory and prints it. Outputs are named after
+    the input files, as with mtrdr_batch(), and extra keyword arguments are passed on to
+    the product function."""
+
+    if not product.startswith("mtrdr_to_") or product not in globals():
+        print("Invalid product, use one of the mtrdr_to_* functions, e.g. 'mtrdr_to_color'.")
+        return
+    render = globals()[product]
+    work = WorkQueue(directory, queue, pattern, stale)
+    attempted = set()
+
+    try:
+        while True:
+            claimed = False
+            waiting = False
+            for file in work.files():
+                key = work.key(file)
+                if key in attempted:
+                    continue
+                state = work.state(key)
+                if state == "done" or (state == "failed" and not retry_failed):
+                    continue
+                token = work.claim(key)
+                if token is None:
+                    waiting = True
+                    continue
+                #Another worker may have finished the image just before the claim
+                if work.state(key) == "done" or (work.state(key) == "failed" and not retry_failed):
+                    work.release(key, token)
+                    continue
+                claimed = True
+                attempted.add(key)
+
+                #Refresh the claim in the background while rendering
+                stop = threading.Event()
+                def beat():
+                    while not stop.wait(heartbeat):
+                        if not work.heartbeat(key, token):
+                            print("Warning: the claim on "+file+" was taken over by another worker")
+                            return
+                beating = threading.Thread(target=beat, daemon=True)
+                beating.start()
+
+                print(work.worker_id+" processing "+file+"...")
+                job = RenderJob(key, product, file, file, params)
+                _render_job.job = job
+                started = time.time()
+                error = None
+                try:
+                    render(file, file, **params)
+                except Exception as exception:
+                    error = str(exception)
+                    print("Error: "+file+": "+error)
+                finally:
+                    _render_job.job = None
+                    stop.set()
+                    beating.join()
+                    MtrdrScene(file).forget()
+
+                record = dict(file=file, product=product, params=params, worker=work.worker_id, host=work.host,
+                              pid=os.getpid(), started=started, finished=time.time(),
+                              elapsed=round(time.time() - started, 3), outputs=job.outputs, error=error)
+                work.finish(key, token, record, failed=error is not None)
+
+            if not claimed and not waiting:
+                break
+            if not claimed:
+                #The rest is claimed by other workers, look again in case one of them dies
+                time.sleep(heartbeat)
+
+        _print_summary(work.summary())
+    finally:
+        #Don't leave a heartbeat file in the queue for every worker run
+        work.leave()
+    return
 
-def mtrdr_to_pancam(file, fname, color="RGB", narrowband=True):
-    
-    ##Data I/O and formatting
-    with rasterio.open(file) as src:
-        profile = src.profile
-        cube = src.read()
-    
-    cube = format_mtrdr(cube)
-    cube = mtrdr_crop_bands(cube, [380, 1150])
-    cube = cube.transpose(1,2,0)
-    cube = np.ma.masked_values(cube, 65535)
-    
-    #Developer note: PanCam filter responses are stored in the following order:
-    #[0] - MTRDR wavelength; [1:8] - L1-L7; [8:] - R1-R7
-    
-    #Filter information retrieved from the Spanish Virtual Observatory Filter Profile Repository
-    filter_response = np.genfromtxt("matching_functions/pancam-response-mtrdr.txt", delimiter="\t")
-    
-    ##Calculate filter images filters via integration
-    
-    l1 = calculate_luminance((filter_response[:, 1]), cube)
-    l2 = calculate_luminance((filter_response[:, 2]), cube)
-    l3 = calculate_luminance((filter_response[:, 3]), cube)
-    l4 = calculate_luminance((filter_response[:, 4]), cube)
-    l5 = calculate_luminance((filter_response[:, 5]), cube)
-    l6 = calculate_luminance((filter_response[:, 6]), cube)
-    l7 = calculate_luminance((filter_response[:, 7]), cube)
-    r1 = calculate_luminance((filter_response[:, 8]), cube)
-    r2 = calculate_luminance((filter_response[:, 9]), cube)
-    r3 = calculate_luminance((filter_response[:, 10]), cube)
-    r4 = calculate_luminance((filter_response[:, 11]), cube)
-    r5 = calculate_luminance((filter_response[:, 12]), cube)
-    r6 = calculate_luminance((filter_response[:, 13]), cube)
-    r7 = calculate_luminance((filter_response[:, 14]), cube)
-    
-    if color == "RGB":
-        export = np.stack((l3, l5, l7))
-        
-    elif color == "IRB":
-        export = np.stack((l2, l5, l7))
-        
+def queue_summary(directory, queue=None, pattern="*if*mtr3*lbl"):
+    """Aggregates and prints the done and failed records of the work queue of worker()."""
+    _print_summary(WorkQueue(directory, queue, pattern).summary())
+    return
+
+#Map tile server
+
+TILE_SIZE = 256
+
+#Longest side of the decimated scene read to compute the global stretch of a tile scene
+STRETCH_SAMPLE = 1024
+
+TILE_VIEWER = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>SCENE</title>
+<link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css">
+<script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
+<style>html, body, #map { height: 100%; margin: 0; background: #000; }</style>
+</head><body><div id="map"></div><script>
+var map = L.map('map', {crs: L.CRS.Simple, minZoom: 0, maxZoom: MAXZOOM});
+var bounds = L.latLngBounds(map.unproject([0, HEIGHT], MAXZOOM), map.unproject([WIDTH, 0], MAXZOOM));
+L.tileLayer('{z}/{x}/{y}.png', {tileSize: TILESIZE, maxZoom: MAXZOOM, bounds: bounds, noWrap: true}).addTo(map);
+map.fitBounds(bounds);
+</script></body></html>
+"""
+
+class TileScene:
+    """An MTRDR scene rendered on request as 256x256 XYZ map tiles with the mtrdr_to_color()
+    pipeline. The highest zoom level shows the scene at full resolution, every lower level
+    halves it. Each tile reads only its own window of the bands needed for wave_range,
+    decimated at low zoom, and is stretched with global statistics computed once per scene
+    from a decimated read of the whole scene."""
+
+    def __init__(self, file, wave_range=(380, 780), mode="raw"):
+        self.file = file
+        self.wave_range = wave_range
+        self.mode = mode
+        self.bands = mtrdr_source_bands(wave_range)
+        self.cs = colour_system("srgb").with_colour_matching(mtrdr_color_matching(wave_range))
+        import rasterio
+        with rasterio.open(file) as src:
+            self.height = src.height
+            self.width = src.width
+        self.max_zoom = max(0, int(np.ceil(np.log2(max(self.height, self.width) / TILE_SIZE))))
+        self.stretch = None
+        self.lock = threading.Lock()
+
+    def read(self, window, out_shape):
+        """Reads and fills a decimated window of the scene, returns it with a mask of valid pixels."""
+        import rasterio
+        with rasterio.open(self.file) as src:
+            return read_filled_window(src, self.bands, window, out_shape)
+
+    def statistics(self):
+        """Returns the global stretch of the scene, computing it on first use."""
+        with self.lock:
+            if self.stretch is None:
+                scale = max(1, int(np.ceil(max(self.height, self.width) / STRETCH_SAMPLE)))
+                img, valid = self.read(None, (int(np.ceil(self.height / scale)), int(np.ceil(self.width / scale))))
+                stretch = {}
+                color_from_cube(mtrdr_crop_bands(img, self.wave_range), self.cs, mode=self.mode, stretch=stretch)
+                self.stretch = stretch
+            return self.stretch
+
+    def tile(self, z, x, y):
+        """Renders tile z/x/y as 8-bit RGBA PNG data, or returns None if it is outside the scene."""
+        if z < 0 or z > self.max_zoom or x < 0 or y < 0:
+            return None
+        scale = 2 ** (self.max_zoom - z)
+        col = x * TILE_SIZE * scale
+        row = y * TILE_SIZE * scale
+        if col >= self.width or row >= self.height:
+            return None
+        width = min(TILE_SIZE * scale, self.width - col)
+        height = min(TILE_SIZE * scale, self.height - row)
+        out_shape = (int(np.ceil(height / scale)), int(np.ceil(width / scale)))
+
+        import rasterio
+        stretch = self.statistics()
+        img, valid = self.read(rasterio.windows.Window(col, row, width, height), out_shape)
+        rgb = color_from_cube(mtrdr_crop_bands(img, self.wave_range), self.cs, mode=self.mode, stretch=stretch)
+
+        #Pad edge tiles to full size with transparent pixels, as do null pixels
+        rgba = np.zeros((4, TILE_SIZE, TILE_SIZE), dtype=np.uint8)
+        rgba[0:3, 0:out_shape[0], 0:out_shape[1]] = rgb >> 8
+        rgba[3, 0:out_shape[0], 0:out_shape[1]] = np.where(valid, 255, 0)
+        with rasterio.MemoryFile() as memfile:
+            with memfile.open(driver='PNG', width=TILE_SIZE, height=TILE_SIZE, count=4, dtype='uint8') as out:
+                out.write(rgba)
+            return memfile.read()
+
+class TileRequestHandler:
+    """Serves /<scene>/<z>/<x>/<y>.png tiles, a viewer page at /<scene>/ and a scene list at /.
+
+    Mixed into http.server.BaseHTTPRequestHandler by serve_tiles()."""
+
+    def do_GET(self):
+        server = self.server.tiles
+        parts = [part for part in self.path.split("?")[0].split("/") if part]
+
+        if not parts:
+            links = "".join('<li><a href="'+name+'/">'+name+'</a></li>' for name in sorted(server.files))
+            return self.respond(200, "text/html", ("<html><body><ul>"+links+"</ul></body></html>").encode())
+
+        if parts[0] not in server.files:
+            return self.respond(404, "text/plain", b"unknown scene")
+        scene = server.scene(parts[0])
+
+        if len(parts) == 1:
+            page = TILE_VIEWER.replace("SCENE", parts[0]).replace("MAXZOOM", str(scene.max_zoom))
+            page = page.replace("HEIGHT", str(scene.height)).replace("WIDTH", str(scene.width))
+            page = page.replace("TILESIZE", str(TILE_SIZE))
+            return self.respond(200, "text/html", page.encode())
+
+        if len(parts) != 4 or not parts[3].endswith(".png"):
+            return self.respond(404, "text/plain", b"not found")
+        try:
+            z, x, y = int(parts[1]), int(parts[2]), int(parts[3][:-4])
+        except ValueError:
+            return self.respond(404, "text/plain", b"not found")
+
+        key = (parts[0], z, x, y)
+        tile = server.cache.get(key)
+        if tile is None:
+            tile = scene.tile(z, x, y)
+            if tile is None:
+                return self.respond(404, "text/plain", b"outside of scene")
+            server.cache.put(key, tile)
+        return self.respond(200, "image/png", tile)
+
+    def respond(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class TileSet:
+    """The tile scenes and the tile cache of a tile server."""
+
+    def __init__(self, files, cache_mb, wave_range, mode):
+        self.files = files
+        self.cache = LRUCache(cache_mb * 1024 * 1024)
+        self.wave_range = wave_range
+        self.mode = mode
+        self.scenes = {}
+        self.lock = threading.Lock()
+
+    def scene(self, name):
+        """Returns the tile scene of a file name, opening it on first use."""
+        with self.lock:
+            if name not in self.scenes:
+                self.scenes[name] = TileScene(self.files[name], self.wave_range, self.mode)
+            return self.scenes[name]
+
+def serve_tiles(path, port=8000, host="127.0.0.1", cache_mb=256, wave_range=(380, 780), mode="raw", pattern="*if*mtr3*lbl"):
+    """Serves MTRDR scenes as XYZ map tiles rendered on request with the mtrdr_to_color() pipeline.
+
+    path is a single MTRDR image or a directory searched for pattern. Tiles are served as
+    http://host:port/<scene>/<z>/<x>/<y>.png, where <scene> is the file name without
+    extension, and a map viewer at http://host:port/<scene>/. Rendered tiles are kept in an
+    LRU cache of at most cache_mb megabytes."""
+
+    if os.path.isdir(path):
+        files = sorted(glob.glob(os.path.join(path, "**", pattern), recursive=True))
     else:
-        print("Invalid color keyword, use 'RGB' or 'IRB'.")
-    
-    export = (export - (np.amin(export) - (0.02*np.amin(export)))) / ((np.amax(export) + (0.02*np.amax(export))))    
-    export = convert_uint16(export)
-    
-    #Update profile for color export
-    profile.update(
-        dtype = rasterio.uint16,
-        count = 3,
-        driver = 'PNG'
-    )
-    
-    with rasterio.open(fname+"_"+color+".png", 'w', **profile) as out:
-                out.write(export)
-    
-    if narrowband == False:
-        return
-    
-    filter_list = [l1, l2, l3, l4, l5, l6, l7, r1, r2, r3, r4, r5, r6, r7]
-    filter_names = ["L1_PAN", "L2_750nm", "L3_670nm", "L4_600nm", "L5_530nm", "L6_480nm", "L7_430nm",
-                   "R1_430nm", "R2_750nm", "R3_800nm", "R4_860nm", "R5_900nm", "R6_930nm", "R7_980nm"]
-    
-    profile.update(
-        dtype = rasterio.uint16,
-        count = 1,
-        driver = 'PNG'
-    )
-    
-    for item, name in zip(filter_list, filter_names):
-        item = np.expand_dims(item, 0)
-        item = convert_uint16(item)
-        with rasterio.open(fname+"_"+name+".png", 'w', **profile) as out:
-                out.write(item)
-                
+        files = [path]
+    files = {os.path.splitext(os.path.basename(file))[0]: file for file in files}
+
+    import rasterio
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    #Tiles are in pixel coordinates, don't warn about their missing georeference
+    warnings.filterwarnings("ignore", category=rasterio.errors.NotGeoreferencedWarning)
+    handler = type("TileRequestHandler", (TileRequestHandler, BaseHTTPRequestHandler), {})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.tiles = TileSet(files, cache_mb, wave_range, mode)
+    print("serving "+str(len(files))+" scenes on http://"+host+":"+str(server.server_address[1])+"/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return
+
+#Render daemon
+
+#Default Unix socket of serve_renders() and the commands talking to it
+RENDER_SOCKET = os.path.join(os.environ.get("TMPDIR", "/tmp"), "crism-render-"+os.environ.get("USER", "default")+".sock")
+
+class RenderCancelled(Exception):
+    """Raised inside a render job which has been cancelled."""
+
+class RenderJob:
+    """A product render queued on serve_renders(), with its state and the files written so far.
+
+    The state goes from "queued" over "running" to "done", "failed" or "cancelled"."""
+
+    def __init__(self, job_id, product, file, name, params):
+        self.id = job_id
+        self.product = product
+        self.file = file
+        self.name = name
+        self.params = params
+        self.state = "queued"
+        self.error = None
+        self.outputs = []
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.cancelled = threading.Event()
+
+    def checkpoint(self):
+        """Raise RenderCancelled if the job has been cancelled. Called between reads and writes."""
+        if self.cancelled.is_set():
+            raise RenderCancelled("job "+str(self.id)+" cancelled")
+
+    def written(self, path):
+        """Record a finished output file."""
+        self.outputs.append(path)
+
+    def status(self):
+        """Returns the job as a JSON-serializable dictionary."""
+        state = self.state
+        if state == "running" and self.cancelled.is_set():
+            state = "cancelling"
+        elapsed = None
+        if self.started is not None:
+            elapsed = round((self.finished or time.time()) - self.started, 3)
+        return dict(job=self.id, state=state, product=self.product, file=self.file, name=self.name,
+                    params=self.params, outputs=list(self.outputs), elapsed=elapsed, error=self.error)
+
+class RenderService:
+    """Job registry and worker pool of serve_renders().
+
+    Jobs run on a pool of worker threads in the daemon process, so the libraries, tables,
+    color matching functions and whiteflat factors loaded by the first job stay loaded
+    for all following ones. on_drained is called once the pool has finished after a
+    shutdown request."""
+
+    def __init__(self, workers=2, on_drained=None):
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.jobs = {}
+        self.next_id = 1
+        self.accepting = True
+        self.on_drained = on_drained
+        self.lock = threading.Lock()
+
+    def handle(self, request):
+        """Answers a client request, a dictionary with "op" set to "submit", "status",
+        "cancel" or "shutdown"."""
+        op = request.get("op")
+        if op == "submit":
+            return self.submit(request.get("product"), request.get("file"), request.get("name"), request.get("params") or {})
+        if op == "status":
+            return self.status(request.get("job"))
+        if op == "cancel":
+            return self.cancel(request.get("job"))
+        if op == "shutdown":
+            return self.shutdown(request.get("drain", True))
+        return dict(error="Invalid op '"+str(op)+"', use 'submit', 'status', 'cancel' or 'shutdown'.")
+
+    def submit(self, product, file, name, params):
+        """Queue a render of file with the product function, output names starting with name."""
+        if not str(product).startswith("mtrdr_to_") or product not in globals():
+            return dict(error="Invalid product, use one of the mtrdr_to_* functions, e.g. 'mtrdr_to_color'.")
+        with self.lock:
+            if not self.accepting:
+                return dict(error="The render daemon is shutting down and doesn't accept new jobs.")
+            job = RenderJob(self.next_id, product, file, name or file, params)
+            self.next_id += 1
+            self.jobs[job.id] = job
+            self.pool.submit(self.run, job)
+            return job.status()
+
+    def run(self, job):
+        """Render a job on a worker thread."""
+        with self.lock:
+            if job.state != "queued":
+                return
+            job.state = "running"
+            job.started = time.time()
+        print("job "+str(job.id)+" running: "+job.product+" "+job.file)
+
+        _render_job.job = job
+        error = None
+        try:
+            globals()[job.product](job.file, job.name, **job.params)
+            state = "done"
+        except RenderCancelled:
+            state = "cancelled"
+        except Exception as exception:
+            state = "failed"
+            error = str(exception)
+        finally:
+            _render_job.job = None
+
+        with self.lock:
+            job.state = state
+            job.error = error
+            job.finished = time.time()
+        print("job "+str(job.id)+" "+state+(": "+error if error else ""))
+
+    def status(self, job_id=None):
+        """Returns the status of one job, or of all jobs if job_id is None."""
+        with self.lock:
+            if job_id is None:
+                return dict(accepting=self.accepting, jobs=[job.status() for job in self.jobs.values()])
+            if job_id not in self.jobs:
+                return dict(error="Unknown job "+str(job_id)+".")
+            return self.jobs[job_id].status()
+
+    def cancel(self, job_id):
+        """Cancel a job. Queued jobs are dropped, running jobs stop at their next read or write."""
+        with self.lock:
+            if job_id not in self.jobs:
+                return dict(error="Unknown job "+str(job_id)+".")
+            job = self.jobs[job_id]
+            self._cancel(job)
+            return job.status()
+
+    def _cancel(self, job):
+        if job.state in ("queued", "running"):
+            job.cancelled.set()
+        if job.state == "queued":
+            job.state = "cancelled"
+            job.finished = time.time()
+
+    def shutdown(self, drain=True):
+        """Stop accepting jobs and call on_drained once the pool is idle. With drain, queued
+        and running jobs are finished first, otherwise they are cancelled."""
+        with self.lock:
+            first = self.accepting
+            self.accepting = False
+            if not drain:
+                for job in self.jobs.values():
+                    self._cancel(job)
+            pending = sum(job.state in ("queued", "running") for job in self.jobs.values())
+        if first:
+            threading.Thread(target=self._drain, daemon=True).start()
+        return dict(accepting=False, pending=pending)
+
+    def _drain(self):
+        self.pool.shutdown(wait=True)
+        print("all jobs finished")
+        if self.on_drained is not None:
+            self.on_drained()
+
+class RenderRequestHandler:
+    """Answers one JSON request line per connection with one JSON response line.
+
+    Mixed into socketserver.StreamRequestHandler by serve_renders()."""
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            request = None
+        if isinstance(request, dict):
+            response = self.server.service.handle(request)
+        else:
+            response = dict(error="Invalid request, send one JSON object per line.")
+        self.wfile.write((json.dumps(response)+"\n").encode())
+
+def _warm_up():
+    """Imports the libraries and loads the tables of all products ahead of the first job."""
+    import rasterio
+    import spectres
+    modify_mtrdr_axis()
+    for name in sorted(os.listdir(MATCHING_FUNCTIONS)):
+        if name.endswith("-response-mtrdr.txt"):
+            load_table(name, delimiter="\t")
+    colour_system("srgb").colour_matching()
+    mtrdr_color_matching([380, 780])
+    if os.path.exists(whiteflat_path()):
+        mtrdr_whiteflat(61)
+
+def serve_renders(socket_path=RENDER_SOCKET, port=None, workers=2):
+    """Runs a render daemon taking mtrdr_to_* jobs from submit_render().
+
+    The daemon listens on the Unix socket socket_path, or on localhost:port if a port is
+    given, and renders up to `workers` jobs at once. Libraries and tables are loaded once at
+    startup instead of in every crism.py run. Jobs can be followed with render_status() and
+    cancelled with cancel_render(). stop_renders(), SIGTERM or Ctrl-C stop taking new jobs
+    and let the queued ones finish before the daemon exits."""
+
+    import signal
+    import socketserver
+
+    _warm_up()
+    handler = type("RenderRequestHandler", (RenderRequestHandler, socketserver.StreamRequestHandler), {})
+    if port is None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = socketserver.ThreadingUnixStreamServer(socket_path, handler)
+        address = socket_path
+    else:
+        server = socketserver.ThreadingTCPServer(("127.0.0.1", port), handler)
+        address = "127.0.0.1:"+str(server.server_address[1])
+    server.daemon_threads = True
+    server.service = RenderService(workers, on_drained=server.shutdown)
+
+    def stop(signum, frame):
+        print("stopping, waiting for the queued jobs...")
+        server.service.shutdown(drain=True)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    print("render daemon with "+str(workers)+" workers listening on "+address)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if port is None and os.path.exists(socket_path):
+            os.remove(socket_path)
+    return
+
+def _render_request(request, socket_path=RENDER_SOCKET, port=None):
+    """Sends a request to serve_renders() and returns its response."""
+    import socket
+    if port is None:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        address = socket_path
+    else:
+        connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        address = ("127.0.0.1", port)
+    try:
+        with connection:
+            connection.connect(address)
+            connection.sendall((json.dumps(request)+"\n").encode())
+            response = connection.makefile("rb").readline()
+    except OSError as error:
+        return dict(error="No render daemon at "+str(address)+": "+str(error))
+    return json.loads(response)
+
+def _print_job(job):
+    line = "job "+str(job["job"])+": "+job["state"]+", "+job["product"]+" "+job["file"]
+    line += ", "+str(len(job["outputs"]))+" files written"
+    if job["elapsed"] is not None:
+        line += ", "+str(job["elapsed"])+" s"
+    if job["error"]:
+        line += ", error: "+job["error"]
+    print(line)
+
+def _print_response(response):
+    if "jobs" in response:
+        for job in response["jobs"]:
+            _print_job(job)
+        if not response["accepting"]:
+            print("shutting down")
+    elif "job" in response:
+        _print_job(response)
+    elif "error" in response:
+        print("Error: "+response["error"])
+    else:
+        print("shutting down, "+str(response["pending"])+" jobs pending")
+
+def submit_render(product, file, name=None, socket_path=RENDER_SOCKET, port=None, **params):
+    """Queues a mtrdr_to_* render on serve_renders(). name defaults to file, as in mtrdr_batch(),
+    and extra keyword arguments are passed on to the product function."""
+    name = os.path.abspath(name if name is not None else file)
+    request = dict(op="submit", product=product, file=os.path.abspath(file), name=name, params=params)
+    _print_response(_render_request(request, socket_path, port))
+    return
+
+def render_status(job=None, socket_path=RENDER_SOCKET, port=None):
+    """Prints the state and progress of one job of serve_renders(), or of all jobs."""
+    _print_response(_render_request(dict(op="status", job=job), socket_path, port))
+    return
+
+def cancel_render(job, socket_path=RENDER_SOCKET, port=None):
+    """Cancels a queued or running job of serve_renders()."""
+    _print_response(_render_request(dict(op="cancel", job=job), socket_path, port))
+    return
+
+def stop_renders(drain=True, socket_path=RENDER_SOCKET, port=None):
+    """Stops serve_renders() after finishing the queued jobs, or after cancelling them if drain is False."""
+    _print_response(_render_request(dict(op="shutdown", drain=drain), socket_path, port))
     return
 
 if __name__ == '__main__':
-  fire.Fire()
+  import fire
+  #Only offer the functions of this module as commands; fire inspecting the imported modules,
+  #classes and tables as well makes --help slow.
+  fire.Fire({name: value for name, value in list(globals().items())
+             if callable(value) and not isinstance(value, type) and not name.startswith("_")
+             and getattr(value, "__module__", None) == __name__})